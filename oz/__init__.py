@@ -35,6 +35,9 @@ _routes = []
 # List of test classes
 _tests = []
 
+# List of callbacks to run on graceful server shutdown
+_shutdown_hooks = []
+
 # Mapping of setting name -> value
 settings = {}
 
@@ -81,6 +84,14 @@ def test(cls):
     _tests.append(cls)
     return cls
 
+def shutdown_hook(fun):
+    """
+    Exposes a callback to be run on the ioloop when the server is gracefully
+    shutting down.
+    """
+    _shutdown_hooks.append(fun)
+    return fun
+
 def plugin(namespace):
     """Loads an oz plugin"""
     __import__(namespace, globals(), locals(), [], 0)
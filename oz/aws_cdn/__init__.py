@@ -10,11 +10,20 @@ try:
 except ImportError:
     S3Connection = None
 
+try:
+    from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+except ImportError:
+    ThreadPoolExecutor = None
+
+import io
 import os
+import json
+import time
 import shutil
+import threading
 import hashlib
 import mimetypes
-from tornado import escape
+from tornado import escape, util
 
 from .actions import *
 from .middleware import *
@@ -29,6 +38,29 @@ def full_path(path, s3_prefix=None):
         path = "%s/%s" % (prefix, path)
     return path
 
+# Redis key templates, formatted with the bucket name, for the cache busters
+# hash and the version key that is bumped whenever cache busters change
+CACHE_BUSTER_REDIS_KEY_TEMPLATE = "cache-buster:{}:v3"
+CACHE_BUSTER_VERSION_REDIS_KEY_TEMPLATE = "cache-buster:{}:version:v3"
+
+# Redis key template, formatted with the bucket name, for the manifest of
+# path -> JSON list of [size, mtime or ETag, hash] of scanned files
+MANIFEST_REDIS_KEY_TEMPLATE = "cache-buster-manifest:{}:v1"
+
+# Name of the S3 metadata field that holds the SHA-256 of uploaded files
+HASH_METADATA_NAME = "sha256"
+
+# Number of bytes read at a time when streaming file contents
+CHUNK_SIZE = 64 * 1024
+
+# Per-thread boto buckets, since boto connections can't be shared by threads
+_thread_buckets = threading.local()
+
+# Mapping of bucket -> (version, mapping of path -> cache buster, time the
+# version was last checked), used when `cdn_cache_buster_refresh_interval` is
+# set
+_cache_busters = {}
+
 def static_url(redis, path):
     """Gets the static path for a file"""
     file_hash = get_cache_buster(redis, path)
@@ -36,15 +68,100 @@ def static_url(redis, path):
 
 def get_cache_buster(redis, path):
     """Gets the cache buster value for a given file path"""
-    return escape.to_unicode(redis.hget("cache-buster:{}:v3".format(oz.settings["s3_bucket"]), full_path(path)))
 
-def set_cache_buster(redis, path, hash):
-    """Sets the cache buster value for a given file path"""
-    redis.hset("cache-buster:{}:v3".format(oz.settings["s3_bucket"]), full_path(path), hash)
+    if oz.settings["cdn_cache_buster_refresh_interval"]:
+        return load_cache_busters(redis).get(full_path(path))
+    else:
+        return escape.to_unicode(redis.hget(CACHE_BUSTER_REDIS_KEY_TEMPLATE.format(oz.settings["s3_bucket"]), full_path(path)))
+
+def set_cache_buster(redis, path, hash, bump_version=True):
+    """
+    Sets the cache buster value for a given file path. Unless
+    `bump_version` is unset, the cache busters' version is bumped so that
+    other processes pick up the change.
+    """
+
+    bucket = oz.settings["s3_bucket"]
+    redis.hset(CACHE_BUSTER_REDIS_KEY_TEMPLATE.format(bucket), full_path(path), hash)
+
+    if bump_version:
+        bump_cache_buster_version(redis)
+
+def remove_cache_buster(redis, path, bump_version=True):
+    """
+    Removes the cache buster for a given file. Unless `bump_version` is
+    unset, the cache busters' version is bumped so that other processes pick
+    up the change.
+    """
+
+    bucket = oz.settings["s3_bucket"]
+    redis.hdel(CACHE_BUSTER_REDIS_KEY_TEMPLATE.format(bucket), full_path(path))
+
+    if bump_version:
+        bump_cache_buster_version(redis)
+
+def bump_cache_buster_version(redis):
+    """
+    Bumps the cache busters' version, so that the in-process copies of them
+    are reloaded
+    """
+
+    bucket = oz.settings["s3_bucket"]
+    redis.incr(CACHE_BUSTER_VERSION_REDIS_KEY_TEMPLATE.format(bucket))
+    _expire_cache_busters(bucket)
+
+def load_cache_busters(redis, refresh_interval=None):
+    """
+    Gets all of the cache busters for the bucket from an in-process copy. The
+    copy is loaded with a single `HGETALL`, and is reloaded when the
+    cache busters' version key has changed. The version key is checked at
+    most once every `refresh_interval` seconds, which defaults to the
+    `cdn_cache_buster_refresh_interval` setting.
+    """
+
+    bucket = oz.settings["s3_bucket"]
+    version_key = CACHE_BUSTER_VERSION_REDIS_KEY_TEMPLATE.format(bucket)
+    now = time.time()
+    cached = _cache_busters.get(bucket)
+
+    if refresh_interval == None:
+        refresh_interval = oz.settings["cdn_cache_buster_refresh_interval"]
 
-def remove_cache_buster(redis, path):
-    """Removes the cache buster for a given file"""
-    redis.hdel("cache-buster:{}:v3".format(oz.settings["s3_bucket"]), full_path(path))
+    if cached != None:
+        version, cache_busters, checked = cached
+
+        if now - checked < refresh_interval:
+            return cache_busters
+
+        if redis.get(version_key) == version:
+            _cache_busters[bucket] = (version, cache_busters, now)
+            return cache_busters
+
+    pipe = redis.pipeline()
+    pipe.get(version_key)
+    pipe.hgetall(CACHE_BUSTER_REDIS_KEY_TEMPLATE.format(bucket))
+    version, cache_busters = pipe.execute()
+    cache_busters = dict((escape.to_unicode(k), escape.to_unicode(v)) for k, v in cache_busters.items())
+    _cache_busters[bucket] = (version, cache_busters, now)
+    return cache_busters
+
+def _expire_cache_busters(bucket):
+    """
+    Makes the next use of the in-process copy of cache busters check whether
+    they have changed
+    """
+
+    cached = _cache_busters.get(bucket)
+
+    if cached != None:
+        _cache_busters[bucket] = (cached[0], cached[1], 0)
+
+def invalidate_cache_busters():
+    """
+    Clears the in-process copy of cache busters, so they're reloaded on next
+    use
+    """
+    _cache_busters.clear()
 
 def get_bucket(s3_bucket=None, validate=False):
     """Gets a bucket from specified settings"""
@@ -63,6 +180,16 @@ def get_bucket(s3_bucket=None, validate=False):
     else:
         raise Exception("S3 not supported in this environment as boto is not installed")
 
+def get_thread_bucket():
+    """Gets a bucket from the specified settings for the current thread"""
+
+    bucket = getattr(_thread_buckets, "bucket", None)
+
+    if bucket == None:
+        bucket = _thread_buckets.bucket = get_bucket()
+
+    return bucket
+
 def get_file(path, s3_bucket=None, s3_prefix=None):
     """Gets a file"""
 
@@ -78,6 +205,161 @@ def get_file(path, s3_bucket=None, s3_prefix=None):
     else:
         return LocalFile(oz.settings["static_path"], path)
 
+def list_files(prefixes):
+    """Generates the files whose paths start with any of the given prefixes"""
+
+    if oz.settings["s3_bucket"]:
+        bucket = get_bucket()
+        seen = set()
+
+        for prefix in prefixes:
+            for key in bucket.list(prefix):
+                if key.name not in seen:
+                    seen.add(key.name)
+                    yield S3File(key)
+    else:
+        static_path = oz.settings["static_path"]
+
+        for root, _, filenames in os.walk(static_path):
+            for filename in filenames:
+                path = os.path.relpath(os.path.join(root, filename), static_path)
+
+                for prefix in prefixes:
+                    if path.startswith(prefix):
+                        yield LocalFile(static_path, path)
+                        break
+
+def _hash_file(f):
+    """
+    Hashes a file, using the current thread's bucket for S3 files. S3 files
+    are fetched with a `HEAD` first, so hashes stored in their metadata can
+    be used. Returns a tuple of the file and its hash.
+    """
+
+    if isinstance(f, S3File):
+        bucket = get_thread_bucket()
+        key = bucket.get_key(f.path()) or bucket.new_key(f.path())
+        return f, S3File(key).hash()
+    else:
+        return f, f.hash()
+
+def hash_files(files, workers=None):
+    """
+    Hashes files on a pool of `workers` threads (by default, the
+    `cdn_scan_workers` setting), generating tuples of each file and its hash
+    as they're completed. At most twice as many files as there are workers
+    are hashed or queued at a time.
+    """
+
+    workers = workers or oz.settings["cdn_scan_workers"]
+
+    if ThreadPoolExecutor == None or workers <= 1:
+        for f in files:
+            yield _hash_file(f)
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            pending = set()
+
+            for f in files:
+                if len(pending) >= workers * 2:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+                    for future in done:
+                        yield future.result()
+
+                pending.add(executor.submit(_hash_file, f))
+
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    yield future.result()
+
+def scan_cache_busters(redis, prefixes, full=False, workers=None, batch_size=None):
+    """
+    (Re-)generates the cache buster values for all files with the specified
+    prefixes. Only files whose size or mtime/ETag changed since the last scan,
+    per the manifest stored in redis, are hashed - unless `full` is set.
+    Cache busters of files that no longer exist are removed. Generates tuples
+    of each updated path and its hash, or `None` if it was removed. The
+    changes are written to redis in batches of `batch_size` files, and the
+    cache busters' version is bumped once, at the end of the scan, if
+    anything changed.
+    """
+
+    batch_size = batch_size or oz.settings["cdn_scan_batch_size"]
+    manifest_key = MANIFEST_REDIS_KEY_TEMPLATE.format(oz.settings["s3_bucket"])
+    manifest = dict((escape.to_unicode(k), json.loads(escape.to_unicode(v))) for k, v in redis.hgetall(manifest_key).items())
+    fingerprints = {}
+    changed = False
+    pipe = redis.pipeline(transaction=False)
+
+    # Number of files whose writes are queued on the pipeline
+    pending = 0
+
+    def changed_files():
+        for f in list_files(prefixes):
+            path = f.path()
+            fingerprint = fingerprints[path] = list(f.fingerprint())
+            entry = manifest.pop(path, None)
+
+            if full or entry == None or entry[:2] != fingerprint:
+                yield f
+
+    for f, file_hash in hash_files(changed_files(), workers=workers):
+        path = f.path()
+        set_cache_buster(pipe, path, file_hash, bump_version=False)
+        changed = True
+        pipe.hset(manifest_key, path, json.dumps(fingerprints.pop(path) + [file_hash]))
+        pending += 1
+        yield path, file_hash
+
+        if pending >= batch_size:
+            pipe.execute()
+            pending = 0
+
+    # Whatever is left in the manifest under the prefixes was not listed, so
+    # it has been deleted
+    for path in manifest:
+        if any(path.startswith(prefix) for prefix in prefixes):
+            remove_cache_buster(pipe, path, bump_version=False)
+            changed = True
+            pipe.hdel(manifest_key, path)
+            pending += 1
+            yield path, None
+
+            if pending >= batch_size:
+                pipe.execute()
+                pending = 0
+
+    if changed:
+        bump_cache_buster_version(pipe)
+
+    pipe.execute()
+
+def iter_chunks(contents, chunk_size=CHUNK_SIZE):
+    """
+    Generates the chunks of upload contents, which can be a bytes object, a
+    file-like object or an iterable of bytes objects
+    """
+
+    if isinstance(contents, (bytes, util.unicode_type)):
+        contents = escape.utf8(contents)
+
+        for i in range(0, len(contents), chunk_size):
+            yield contents[i:i + chunk_size]
+    elif hasattr(contents, "read"):
+        while True:
+            chunk = contents.read(chunk_size)
+
+            if not chunk:
+                break
+
+            yield escape.utf8(chunk)
+    else:
+        for chunk in contents:
+            yield escape.utf8(chunk)
+
 class CDNFile(object):
     """File spec for a CDN/S3-hosted file"""
 
@@ -91,18 +373,49 @@ class CDNFile(object):
             return False
 
     def hash(self):
-        """Creates a cache buster value for the file"""
-        return hashlib.sha256(self.contents()).hexdigest()
+        """
+        Creates a cache buster value for the file. The value is memoized for
+        as long as the file's fingerprint stays the same.
+        """
+
+        fingerprint = self.fingerprint()
+        memo = getattr(self, "_hash_memo", None)
+
+        if memo != None and memo[0] == fingerprint:
+            return memo[1]
+
+        file_hash = self._compute_hash()
+        self._hash_memo = (fingerprint, file_hash)
+        return file_hash
+
+    def _compute_hash(self):
+        """Computes the SHA-256 of the file's contents"""
+        hasher = hashlib.sha256()
+
+        for chunk in self.chunks():
+            hasher.update(chunk)
+
+        return hasher.hexdigest()
 
     def path(self):
         """Gets the path of the file"""
         raise NotImplementedError()
 
+    def fingerprint(self):
+        """
+        Gets a tuple of the size of the file and a value that changes when
+        the file is modified, e.g. its mtime
+        """
+        raise NotImplementedError()
+
     def upload(self, contents, replace=False):
         """
         Uploads the file to its path with the given `content`, adding the
         appropriate parent directories when needed. If the path already exists
-        and `replace` is `False`, the file will not be uploaded.
+        and `replace` is `False`, the file will not be uploaded. `contents`
+        can be a bytes object, a file-like object or an iterable of bytes
+        objects, and is streamed rather than read into memory. Returns the
+        hash of the uploaded contents, or `None` if it wasn't uploaded.
         """
         raise NotImplementedError()
 
@@ -110,6 +423,10 @@ class CDNFile(object):
         """Gets the contents of the file"""
         raise NotImplementedError()
 
+    def chunks(self, chunk_size=CHUNK_SIZE):
+        """Generates the contents of the file in chunks of `chunk_size` bytes"""
+        yield self.contents()
+
     def exists(self):
         """Returns whether the path exists"""
         raise NotImplementedError()
@@ -133,6 +450,10 @@ class LocalFile(CDNFile):
     def path(self):
         return self.file_path
 
+    def fingerprint(self):
+        stat = os.stat(self.full_path)
+        return stat.st_size, stat.st_mtime
+
     def upload(self, contents, replace=False):
         if replace or not os.path.exists(self.full_path):
             try:
@@ -140,13 +461,30 @@ class LocalFile(CDNFile):
             except:
                 pass
 
+            hasher = hashlib.sha256()
+
             with open(self.full_path, "wb") as f:
-                f.write(contents)
+                for chunk in iter_chunks(contents):
+                    hasher.update(chunk)
+                    f.write(chunk)
+
+            self._hash_memo = (self.fingerprint(), hasher.hexdigest())
+            return hasher.hexdigest()
 
     def contents(self):
         with open(self.full_path, "rb") as f:
             return f.read()
 
+    def chunks(self, chunk_size=CHUNK_SIZE):
+        with open(self.full_path, "rb") as f:
+            while True:
+                chunk = f.read(chunk_size)
+
+                if not chunk:
+                    break
+
+                yield chunk
+
     def exists(self):
         return os.path.exists(self.full_path)
 
@@ -171,19 +509,94 @@ class S3File(CDNFile):
     def path(self):
         return self.key.name
 
+    def fingerprint(self):
+        return self.key.size, self.key.etag
+
     def upload(self, contents, replace=False):
+        """
+        Uploads the file as in `CDNFile.upload`. Contents larger than
+        `cdn_multipart_threshold` bytes are sent with a multipart upload, in
+        parts of that size. Otherwise, the hash is stored in the file's
+        metadata so it doesn't need to be downloaded to get its hash later.
+        """
+
         if replace or not self.key.exists():
             guessed_type = mimetypes.guess_type(self.path())[0]
-
-            self.key.set_contents_from_string(contents, {
+            headers = {
                 "Content-Type": guessed_type or "binary/octet-stream",
                 "Cache-Control": "max-age=155520000, public",
                 "Expires": "Sat, 29 Apr 2017 13:31:45-0000 GMT"
-            })
+            }
+
+            part_size = oz.settings["cdn_multipart_threshold"]
+            hasher = hashlib.sha256()
+            multipart_upload = None
+            part_num = 0
+            buf = []
+            buf_size = 0
+            size = 0
+
+            try:
+                for chunk in iter_chunks(contents):
+                    hasher.update(chunk)
+                    buf.append(chunk)
+                    buf_size += len(chunk)
+                    size += len(chunk)
+
+                    if buf_size > part_size:
+                        if multipart_upload == None:
+                            multipart_upload = self.key.bucket.initiate_multipart_upload(self.key.name, headers=headers)
+
+                        part_num += 1
+                        multipart_upload.upload_part_from_file(io.BytesIO(b"".join(buf)), part_num)
+                        buf = []
+                        buf_size = 0
+
+                if multipart_upload == None:
+                    self.key.set_metadata(HASH_METADATA_NAME, hasher.hexdigest())
+                    self.key.set_contents_from_string(b"".join(buf), headers)
+                else:
+                    if buf:
+                        part_num += 1
+                        multipart_upload.upload_part_from_file(io.BytesIO(b"".join(buf)), part_num)
+
+                    self.key.etag = multipart_upload.complete_upload().etag
+                    self.key.size = size
+                    self.key.metadata.pop(HASH_METADATA_NAME, None)
+            except:
+                if multipart_upload != None:
+                    multipart_upload.cancel_upload()
+
+                raise
+
+            self._hash_memo = (self.fingerprint(), hasher.hexdigest())
+            return hasher.hexdigest()
+
+    def _compute_hash(self):
+        # Use the hash stored with the file on upload if there is one. S3
+        # replaces metadata whenever the contents change, so it can't be stale.
+        stored_hash = self.key.get_metadata(HASH_METADATA_NAME)
+
+        if stored_hash:
+            return escape.to_unicode(stored_hash)
+
+        return super(S3File, self)._compute_hash()
 
     def contents(self):
         return self.key.get_contents_as_string()
 
+    def chunks(self, chunk_size=CHUNK_SIZE):
+        try:
+            while True:
+                chunk = self.key.read(chunk_size)
+
+                if not chunk:
+                    break
+
+                yield chunk
+        finally:
+            self.key.close()
+
     def exists(self):
         return self.key.exists()
 
@@ -3,6 +3,7 @@
 from __future__ import absolute_import, division, print_function, with_statement, unicode_literals
 
 import oz
+import oz.redis
 import oz.aws_cdn
 
 class CDNMiddleware(object):
@@ -17,19 +18,33 @@ class CDNMiddleware(object):
         Takes a path and returns a static URL based on the CDN configuration.
         Largely a drop-in replacement for tornado's `static_url`.
         """
-        return oz.aws_cdn.static_url(self.redis(), path)
+        return oz.aws_cdn.static_url(self.redis("cdn"), path)
+
+    def cdn_static_url_async(self, path):
+        """
+        Like `cdn_static_url`, but without blocking the ioloop. Returns a
+        future.
+        """
+        return oz.redis.run_async(self.cdn_static_url, path)
 
     def get_cache_buster(self, path):
         """Gets the cache buster value for a given file path"""
-        return oz.aws_cdn.get_cache_buster(self.redis(), path)
+        return oz.aws_cdn.get_cache_buster(self.redis("cdn"), path)
+
+    def get_cache_buster_async(self, path):
+        """
+        Gets the cache buster value for a given file path without blocking the
+        ioloop. Returns a future.
+        """
+        return oz.redis.run_async(self.get_cache_buster, path)
 
     def set_cache_buster(self, path, hash):
         """Sets the cache buster value for a given file path"""
-        oz.aws_cdn.set_cache_buster(self.redis(), path, hash)
+        oz.aws_cdn.set_cache_buster(self.redis("cdn"), path, hash)
 
     def remove_cache_buster(self, path):
         """Removes the cache buster for a given file"""
-        oz.aws_cdn.remove_cache_buster(self.redis(), path)
+        oz.aws_cdn.remove_cache_buster(self.redis("cdn"), path)
 
     def get_file(self, path):
         """Gets a file at the given path"""
@@ -39,11 +54,19 @@ class CDNMiddleware(object):
         """
         Uplodas the file to its path with the given `content`, adding the
         appropriate parent directories when needed. If the path already exists
-        and `replace` is `False`, the file will not be uploaded.
+        and `replace` is `False`, the file will not be uploaded. `contents`
+        can be a bytes object, a file-like object or an iterable of bytes
+        objects.
         """
         f = self.get_file(path)
-        f.upload(contents, replace=replace)
-        self.set_cache_buster(path, f.hash())
+        file_hash = f.upload(contents, replace=replace)
+
+        # The file wasn't replaced, so make sure the cache buster matches
+        # the existing file
+        if file_hash == None:
+            file_hash = f.hash()
+
+        self.set_cache_buster(path, file_hash)
 
     def copy_file(self, from_path, to_path, replace=False):
         """
@@ -54,6 +77,7 @@ class CDNMiddleware(object):
         """
         f = self.get_file(from_path)
         if f.copy(to_path, replace):
+            # The copy has the same contents, so reuse the source's hash
             self.set_cache_buster(to_path, f.hash())
 
     def remove_file(self, path):
@@ -10,5 +10,9 @@ oz.options(
     static_host = dict(type=str, help="CDN hostname for static assets"),
     s3_bucket = dict(type=str, default=None, help="S3 bucket for uploading CDN assets"),
     s3_prefix = dict(type=str, default="", help="S3 key prefix to apply when operating on CDN assets"),
-    s3_host = dict(type=str, default=None, help="S3 host to use for signature generation")
+    s3_host = dict(type=str, default=None, help="S3 host to use for signature generation"),
+    cdn_cache_buster_refresh_interval = dict(type=float, default=0, help="If set, cache busters are kept in-process and checked for changes at most every this many seconds"),
+    cdn_scan_workers = dict(type=int, default=8, help="Number of threads that hash files in cache_busting_scan"),
+    cdn_scan_batch_size = dict(type=int, default=500, help="Number of files whose cache busters cache_busting_scan writes to redis at a time"),
+    cdn_multipart_threshold = dict(type=int, default=16 * 1024 * 1024, help="Size in bytes above which S3 uploads are sent in multiple parts of this size; must be at least 5MB")
 )
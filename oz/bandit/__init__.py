@@ -2,42 +2,119 @@
 
 from __future__ import absolute_import, division, print_function, with_statement, unicode_literals
 
-from tornado import escape, util
+from tornado import escape, util, ioloop
+import oz.redis
+from redis.exceptions import WatchError
 from .actions import *
 from .middleware import *
+from .options import *
+from .strategies import *
 
 import re
+import math
+import time
+import threading
+import collections
 
 ACTIVE_EXPERIMENTS_REDIS_KEY = "bandit:listing:active:v2"
 ARCHIVED_EXPERIMENTS_REDIS_KEY = "bandit:listing:archived:v2"
 EXPERIMENT_REDIS_KEY_TEMPLATE = "bandit:experiment:%s:v2"
+DIRTY_EXPERIMENTS_REDIS_KEY = "bandit:listing:dirty:v2"
 ALLOWED_NAMES = re.compile("^[A-Za-z0-9-_]+$")
 
-# Via http://passel.unl.edu/Image/Namuth-CovertDeana956176274/chi-sqaure%20distribution%20table.PNG
-# Ideally this would be computed on-the-fly. If you know your differential
-# equations, PR please!
-CHI_SQUARE_DISTRIBUTION = [
-    3.84,
-    5.99,
-    7.81,
-    9.49,
-    11.07,
-    12.59,
-    14.07,
-    15.51,
-    16.92,
-    18.31,
-    19.68,
-    21.03,
-    22.36,
-    23.68,
-    25.00,
-    26.30,
-    27.59,
-    28.87,
-    30.14,
-    31.41,
-]
+# Number of times `sync_from_spec` retries its transaction when the
+# experiment listings are concurrently modified
+SYNC_MAX_RETRIES = 10
+
+# Memoized chi squared critical values of (degrees of freedom, alpha) -> value
+_critical_values = {}
+
+# Process-local cache of experiment name -> (expiration timestamp, snapshot of
+# the experiment's redis hash)
+_experiment_cache = {}
+
+# The registered `ASSIGN_CHOICE_SCRIPT`, loaded lazily
+_assign_choice_script = None
+
+# Buffered counter increments of (experiment name, field) -> count, waiting to
+# be flushed to redis
+_pending_counts = collections.defaultdict(int)
+_pending_counts_lock = threading.Lock()
+
+# The periodic callback that flushes buffered counter increments, along with
+# the ioloop it was scheduled on
+_flush_callback = None
+
+# Lua script that opts a session into an experiment choice and counts a play
+# for that choice, atomically and in a single round trip. The session's
+# existing choice is kept if it's still one of the experiment's choices;
+# otherwise the session joins the candidate choice, if any. Existing choices
+# may be stored raw, or serialized as JSON or msgpack (see
+# `oz.redis_sessions.serialize_value`); compressed ones are treated as
+# invalid. The candidate is stored already serialized.
+#
+# KEYS: session hash, experiment hash, dirty experiments set
+# ARGV: session field, candidate choice, session expiration in seconds,
+#       experiment name, current counter bucket (empty if bucketing is off),
+#       serialized candidate choice
+ASSIGN_CHOICE_SCRIPT = """
+local stored = redis.call("HGET", KEYS[1], ARGV[1])
+local choice = nil
+local valid = false
+
+if stored then
+    local marker = string.sub(stored, 1, 2)
+    local ok = true
+
+    if marker == "\\0j" then
+        ok, choice = pcall(cjson.decode, string.sub(stored, 3))
+    elseif marker == "\\0m" then
+        ok, choice = pcall(cmsgpack.unpack, string.sub(stored, 3))
+    elseif string.sub(stored, 1, 1) ~= "\\0" then
+        choice = stored
+    end
+
+    if ok and type(choice) == "string" then
+        local choices = redis.call("HGET", KEYS[2], "choices")
+
+        if choices then
+            for _, name in ipairs(cjson.decode(choices)) do
+                if name == choice then
+                    valid = true
+                    break
+                end
+            end
+        end
+    end
+end
+
+if not valid then
+    if ARGV[2] == "" then
+        return false
+    end
+
+    choice = ARGV[2]
+    redis.call("HSET", KEYS[1], ARGV[1], ARGV[6])
+end
+
+if tonumber(ARGV[3]) > 0 then
+    redis.call("EXPIRE", KEYS[1], ARGV[3])
+end
+
+redis.call("HINCRBY", KEYS[2], choice .. ":plays", 1)
+
+if ARGV[5] ~= "" then
+    redis.call("HINCRBY", KEYS[2], choice .. ":plays:" .. ARGV[5], 1)
+end
+
+redis.call("SADD", KEYS[3], ARGV[4])
+return choice
+"""
+
+# Convergence parameters for the incomplete gamma function computations
+GAMMA_MAX_ITERATIONS = 10000
+GAMMA_EPSILON = 1e-15
+GAMMA_FLOAT_MIN = 1e-300
 
 def chi_squared(*choices):
     """Calculates the chi squared"""
@@ -51,28 +128,202 @@ def chi_squared(*choices):
         + term(mean_failure_rate * c.plays, c.plays - c.rewards
     ) for c in choices])
 
-def is_confident(csq, num_choices):
+def regularized_upper_gamma(a, x):
     """
-    Returns whether an experiment is statistically significant with 95%%
-    confidence
+    Computes the regularized upper incomplete gamma function Q(a, x), using
+    its series representation for small `x` and its continued fraction
+    representation otherwise (see Numerical Recipes, section 6.2.)
     """
-    return csq >= CHI_SQUARE_DISTRIBUTION[num_choices - 2]
+
+    if x <= 0:
+        return 1.0
+
+    log_prefix = -x + a * math.log(x) - math.lgamma(a)
+
+    if x < a + 1:
+        # Series for P(a, x); Q(a, x) = 1 - P(a, x)
+        denominator = a
+        term = total = 1.0 / a
+
+        for _ in range(GAMMA_MAX_ITERATIONS):
+            denominator += 1
+            term *= x / denominator
+            total += term
+
+            if abs(term) < abs(total) * GAMMA_EPSILON:
+                break
+
+        return max(1.0 - total * math.exp(log_prefix), 0.0)
+    else:
+        # Continued fraction for Q(a, x), evaluated with the modified Lentz
+        # method
+        b = x + 1 - a
+        c = 1.0 / GAMMA_FLOAT_MIN
+        d = 1.0 / b
+        total = d
+
+        for i in range(1, GAMMA_MAX_ITERATIONS):
+            an = -i * (i - a)
+            b += 2
+            d = an * d + b
+            d = 1.0 / (d if abs(d) >= GAMMA_FLOAT_MIN else GAMMA_FLOAT_MIN)
+            c = b + an / c
+            c = c if abs(c) >= GAMMA_FLOAT_MIN else GAMMA_FLOAT_MIN
+            delta = d * c
+            total *= delta
+
+            if abs(delta - 1) < GAMMA_EPSILON:
+                break
+
+        return math.exp(log_prefix) * total
+
+def chi_squared_p_value(csq, degrees_of_freedom):
+    """
+    Returns the p-value of a chi squared statistic - i.e. the chi squared
+    distribution's survival function
+    """
+    return regularized_upper_gamma(degrees_of_freedom / 2.0, csq / 2.0)
+
+def chi_squared_critical_value(degrees_of_freedom, alpha):
+    """
+    Returns the chi squared value at or above which results are significant
+    at the given `alpha`. Values are memoized, since they are typically
+    needed for the same handful of parameters over and over.
+    """
+
+    key = (degrees_of_freedom, alpha)
+
+    if key not in _critical_values:
+        low = 0.0
+        high = float(max(degrees_of_freedom, 1))
+
+        while chi_squared_p_value(high, degrees_of_freedom) > alpha:
+            low = high
+            high *= 2
+
+        # The survival function is monotonically decreasing, so bisect
+        while high - low > 1e-9 * high:
+            middle = (low + high) / 2
+
+            if chi_squared_p_value(middle, degrees_of_freedom) > alpha:
+                low = middle
+            else:
+                high = middle
+
+        _critical_values[key] = high
+
+    return _critical_values[key]
+
+def is_confident(csq, num_choices, confidence=None):
+    """
+    Returns whether an experiment is statistically significant. The
+    confidence level defaults to the `bandit_confidence` option.
+    """
+
+    confidence = confidence or oz.settings["bandit_confidence"]
+    return csq >= chi_squared_critical_value(num_choices - 1, 1 - confidence)
 
 def parse_json(raw):
     """Parses raw bytes to a JSON object with unicode strings"""
     return escape.recursive_unicode(escape.json_decode(raw)) if raw != None else None
 
-def sync_from_spec(redis, schema):
+class SpecPlan(object):
     """
-    Takes an input experiment spec and creates/modifies/archives the existing
-    experiments to match the spec.
+    The changes needed to make the stored experiments match an experiment
+    spec. Nothing is written to redis until the plan is applied.
+    """
+
+    def __init__(self):
+        # Names of archived experiments that are in the spec
+        self.dearchived = []
+
+        # Mapping of new experiment name -> choice names
+        self.created = {}
+
+        # Names of active experiments that are not in the spec
+        self.archived = []
+
+        # Mapping of existing experiment name -> (added choice names, removed
+        # choice names, new list of choice names)
+        self.modified = {}
+
+    def __bool__(self):
+        return bool(self.dearchived or self.created or self.archived or self.modified)
+
+    __nonzero__ = __bool__
+
+    def __str__(self):
+        return "\n".join(self.describe())
+
+    def describe(self):
+        """Returns a list of human-readable descriptions of the changes"""
+
+        lines = []
+
+        for name in self.dearchived:
+            lines.append("- De-archiving %s" % name)
+
+        for name, choice_names in sorted(self.created.items()):
+            lines.append("- Creating experiment %s" % name)
+            lines.extend("  - Adding choice %s" % choice_name for choice_name in choice_names)
+
+        for name in self.archived:
+            lines.append("- Archiving %s" % name)
+
+        for name, (added, removed, _) in sorted(self.modified.items()):
+            lines.extend("- Adding choice %s to existing experiment %s" % (choice_name, name) for choice_name in added)
+            lines.extend("- Removing choice %s from existing experiment %s" % (choice_name, name) for choice_name in removed)
+
+        return lines
+
+    def queue(self, pipe):
+        """Queues all of the changes on a pipeline"""
+
+        for name in self.dearchived:
+            pipe.sadd(ACTIVE_EXPERIMENTS_REDIS_KEY, name)
+            pipe.srem(ARCHIVED_EXPERIMENTS_REDIS_KEY, name)
+
+        for name, choice_names in self.created.items():
+            json = dict(creation_date=util.unicode_type(datetime.datetime.now()))
+            pipe.sadd(ACTIVE_EXPERIMENTS_REDIS_KEY, name)
+            pipe.srem(ARCHIVED_EXPERIMENTS_REDIS_KEY, name)
+            pipe.hset(EXPERIMENT_REDIS_KEY_TEMPLATE % name, "metadata", escape.json_encode(json))
+            pipe.hset(EXPERIMENT_REDIS_KEY_TEMPLATE % name, "choices", escape.json_encode(choice_names))
+
+        for name in self.archived:
+            pipe.srem(ACTIVE_EXPERIMENTS_REDIS_KEY, name)
+            pipe.sadd(ARCHIVED_EXPERIMENTS_REDIS_KEY, name)
+
+        for name, (_, _, choice_names) in self.modified.items():
+            pipe.hset(EXPERIMENT_REDIS_KEY_TEMPLATE % name, "choices", escape.json_encode(choice_names))
+
+        changed_choice_names = list(self.created.keys()) + list(self.modified.keys())
+
+        if changed_choice_names:
+            pipe.sadd(DIRTY_EXPERIMENTS_REDIS_KEY, *changed_choice_names)
+
+    def invalidate_cache(self):
+        """Removes every experiment touched by the plan from the experiment cache"""
+
+        for name in self.dearchived + list(self.created.keys()) + self.archived + list(self.modified.keys()):
+            invalidate_cached_experiment(name)
+
+def plan_from_spec(redis, schema, pipe=None):
+    """
+    Computes the changes needed to make the stored experiments match an
+    experiment spec, and returns them as a `SpecPlan`. Raises an
+    `ExperimentException` if the spec has illegal or duplicate names. If
+    `pipe` is specified, the active and archived experiment listings are
+    `WATCH`ed on it. Experiment hashes aren't watched, since every play
+    changes them.
 
     If there's an experiment in the spec that currently doesn't exist, it will
     be created along with the associated choices.
 
-    If there's an experiment in the spec that currently exists, and the set of
-    choices are different, that experiment's choices will be modified to match
-    the spec.
+    If there's an experiment in the spec that currently exists (or is
+    archived), and the set of choices are different, that experiment's
+    choices will be modified to match the spec. Archived experiments will be
+    de-archived.
 
     If there's an experiment not in the spec that currently exists, it will be
     archived.
@@ -85,72 +336,82 @@ def sync_from_spec(redis, schema):
     }
     """
 
-    def get_experiments_dict(active=True):
-        """Returns a dictionary of experiment names -> experiment objects"""
-        return dict((experiment.name, experiment) for experiment in get_experiments(redis, active=active))
+    for name, choice_names in schema.items():
+        if not ALLOWED_NAMES.match(name):
+            raise ExperimentException(name, "Illegal name")
 
-    # Get the current experiments
-    active_experiments = get_experiments_dict()
-    archived_experiments = get_experiments_dict(active=False)
+        for choice_name in choice_names:
+            if not ALLOWED_NAMES.match(choice_name):
+                raise ExperimentException(name, "Illegal choice name: %s" % choice_name)
 
-    # Get the newly defined experiment names and the names of the experiments
-    # already setup
-    new_experiment_names = set(schema.keys())
-    active_experiment_names = set(active_experiments.keys())
+        if len(set(choice_names)) != len(choice_names):
+            raise ExperimentException(name, "Duplicate choice names")
 
-    # Find all the experiments that are in the schema and are defined among the
-    # archived experiments, but not the active ones (we check against active
-    # experiments to prevent the edge case where an experiment might be defined
-    # doubly in both active and archived experiments)
-    unarchivable_experiment_names = (new_experiment_names - active_experiment_names) & set(archived_experiments.keys())
+    if pipe != None:
+        pipe.watch(ACTIVE_EXPERIMENTS_REDIS_KEY, ARCHIVED_EXPERIMENTS_REDIS_KEY)
 
-    # De-archive the necessary experiments
-    for unarchivable_experiment_name in unarchivable_experiment_names:
-        print("- De-archiving %s" % unarchivable_experiment_name)
+    listing_pipe = redis.pipeline(transaction=False)
+    listing_pipe.smembers(ACTIVE_EXPERIMENTS_REDIS_KEY)
+    listing_pipe.smembers(ARCHIVED_EXPERIMENTS_REDIS_KEY)
+    active_names, archived_names = [set(escape.to_unicode(name) for name in names) for names in listing_pipe.execute()]
 
-        # Because there is no function to de-archive an experiment, it must
-        # be done manually
-        pipe = redis.pipeline(transaction=True)
-        pipe.sadd(ACTIVE_EXPERIMENTS_REDIS_KEY, unarchivable_experiment_name)
-        pipe.srem(ARCHIVED_EXPERIMENTS_REDIS_KEY, unarchivable_experiment_name)
-        pipe.execute()
+    # Only experiments in the spec need to be loaded to diff their choices
+    existing_names = [name for name in schema.keys() if name in active_names or name in archived_names]
+    existing_experiments = dict((experiment.name, experiment) for experiment in load_experiments(redis, existing_names, skip_missing=True))
+    plan = SpecPlan()
 
-    # Reload the active experiments if we de-archived any
-    if unarchivable_experiment_names:
-        active_experiments = get_experiments_dict()
-        active_experiment_names = set(active_experiments.keys())
+    for name, choice_names in schema.items():
+        experiment = existing_experiments.get(name)
 
-    # Create the new experiments
-    for new_experiment_name in new_experiment_names - active_experiment_names:
-        print("- Creating experiment %s" % new_experiment_name)
+        if experiment == None:
+            plan.created[name] = list(choice_names)
+            continue
 
-        experiment = add_experiment(redis, new_experiment_name)
+        # Experiments defined doubly in both active and archived experiments
+        # are considered active
+        if name not in active_names:
+            plan.dearchived.append(name)
 
-        for choice in schema[new_experiment_name]:
-            print("  - Adding choice %s" % choice)
-            experiment.add_choice(choice)
+        old_choice_names = experiment.choice_names
+        added = [choice_name for choice_name in choice_names if choice_name not in old_choice_names]
+        removed = [choice_name for choice_name in old_choice_names if choice_name not in choice_names]
 
-    # Archive experiments not defined in the schema
-    for archivable_experiment_name in active_experiment_names - new_experiment_names:
-        print("- Archiving %s" % archivable_experiment_name)
-        active_experiments[archivable_experiment_name].archive()
+        if added or removed:
+            plan.modified[name] = (added, removed, [choice_name for choice_name in old_choice_names if choice_name not in removed] + added)
 
-    # Update the choices for existing experiments that are also defined in the
-    # schema
-    for experiment_name in new_experiment_names & active_experiment_names:
-        experiment = active_experiments[experiment_name]
-        new_choice_names = set(schema[experiment_name])
-        old_choice_names = set(experiment.choice_names)
+    plan.archived = sorted(active_names - set(schema.keys()))
+    plan.dearchived.sort()
+    return plan
 
-        # Add choices in the schema that do not exist yet
-        for new_choice_name in new_choice_names - old_choice_names:
-            print("- Adding choice %s to existing experiment %s" % (new_choice_name, experiment_name))
-            experiment.add_choice(new_choice_name)
+def sync_from_spec(redis, schema, dry_run=False):
+    """
+    Takes an input experiment spec and creates/modifies/archives the existing
+    experiments to match the spec (see `plan_from_spec`.) All of the changes
+    are applied in a single transaction, which is retried up to
+    `SYNC_MAX_RETRIES` times if the experiment listings are concurrently
+    modified. If `dry_run` is set, nothing is written.
 
-        # Remove choices that aren't in the schema
-        for removable_choice_name in old_choice_names - new_choice_names:
-            print("- Removing choice %s from existing experiment %s" % (removable_choice_name, experiment_name))
-            experiment.remove_choice(removable_choice_name)
+    Returns the applied (or, for dry runs, planned) `SpecPlan`.
+    """
+
+    if dry_run:
+        return plan_from_spec(redis, schema)
+
+    with redis.pipeline(transaction=True) as pipe:
+        for _ in range(SYNC_MAX_RETRIES):
+            try:
+                plan = plan_from_spec(redis, schema, pipe=pipe)
+                pipe.multi()
+                plan.queue(pipe)
+                pipe.execute()
+                break
+            except WatchError:
+                continue
+        else:
+            raise Exception("Experiment listings kept changing while syncing from the spec; gave up after %s attempts" % SYNC_MAX_RETRIES)
+
+    plan.invalidate_cache()
+    return plan
 
 class ExperimentException(Exception):
     """
@@ -165,41 +426,100 @@ class ExperimentException(Exception):
 class Experiment(object):
     """Specification for a bandit experiment"""
 
-    def __init__(self, redis, name):
+    def __init__(self, redis, name, data=None):
         self.redis = redis
         self.name = name
-        self.refresh()
+
+        if data == None:
+            self.refresh()
+        else:
+            self._load(data)
 
     def refresh(self):
-        """Re-pulls the data from redis"""
-        pipe = self.redis.pipeline()
-        pipe.hget(EXPERIMENT_REDIS_KEY_TEMPLATE % self.name, "metadata")
-        pipe.hget(EXPERIMENT_REDIS_KEY_TEMPLATE % self.name, "choices")
-        pipe.hget(EXPERIMENT_REDIS_KEY_TEMPLATE % self.name, "default-choice")
-        results = pipe.execute()
+        """
+        Re-pulls the data from redis. The metadata, choices, default choice
+        and every choice's counters are fetched in a single round trip.
+        """
+        self._load(self.redis.hgetall(EXPERIMENT_REDIS_KEY_TEMPLATE % self.name))
+
+    def _load(self, data):
+        """Populates the experiment from a snapshot of its redis hash"""
 
-        if results[0] == None:
+        data = dict((escape.to_unicode(key), value) for key, value in data.items())
+
+        if data.get("metadata") == None:
             raise ExperimentException(self.name, "Does not exist")
 
-        self.metadata = parse_json(results[0])
-        self.choice_names = parse_json(results[1]) if results[1] != None else []
-        self.default_choice = escape.to_unicode(results[2])
+        self.metadata = parse_json(data["metadata"])
+        self.choice_names = parse_json(data.get("choices")) or []
+        self.default_choice = escape.to_unicode(data.get("default-choice"))
+
+        # Choice names cannot contain colons, so any `<choice>:<counter>`
+        # field is unambiguous
+        self.counters = dict((key, int(value)) for key, value in data.items() if ":" in key)
         self._choices = None
 
+    @property
+    def strategy(self):
+        """
+        Gets the allocation strategy for the experiment, as specified in its
+        metadata. Falls back to the default strategy if the specified one is
+        unknown.
+        """
+        return STRATEGIES.get(self.metadata.get("strategy"), STRATEGIES[DEFAULT_STRATEGY])
+
+    def set_strategy(self, strategy):
+        """Sets the allocation strategy for the experiment"""
+
+        if strategy not in STRATEGIES:
+            raise ExperimentException(self.name, "Unknown strategy: %s" % strategy)
+
+        self.metadata["strategy"] = strategy
+        self.redis.hset(EXPERIMENT_REDIS_KEY_TEMPLATE % self.name, "metadata", escape.json_encode(self.metadata))
+        invalidate_cached_experiment(self.name)
+
     @property
     def choices(self):
         """Gets the experiment choices"""
 
         if self._choices == None:
-            self._choices = [ExperimentChoice(self, choice_name) for choice_name in self.choice_names]
+            self._choices = [ExperimentChoice(self, choice_name, *self._choice_counts(choice_name)) for choice_name in self.choice_names]
 
         return self._choices
 
-    def confidence(self):
+    def _choice_counts(self, choice_name):
+        """
+        Returns a tuple (plays, rewards, buckets) of a choice's counters from
+        the loaded snapshot. `buckets` maps bucket -> (plays, rewards) if
+        bucketed counters are enabled, and is `None` otherwise.
+        """
+
+        plays = self.counters.get("%s:plays" % choice_name, 0)
+        rewards = self.counters.get("%s:rewards" % choice_name, 0)
+        buckets = None
+
+        if oz.settings["bandit_bucket_seconds"]:
+            buckets = {}
+
+            for key, value in self.counters.items():
+                parts = key.split(":")
+
+                if len(parts) == 3 and parts[0] == choice_name:
+                    bucket_plays, bucket_rewards = buckets.get(int(parts[2]), (0, 0))
+
+                    if parts[1] == "plays":
+                        buckets[int(parts[2])] = (bucket_plays + value, bucket_rewards)
+                    elif parts[1] == "rewards":
+                        buckets[int(parts[2])] = (bucket_plays, bucket_rewards + value)
+
+        return (plays, rewards, buckets)
+
+    def confidence(self, confidence=None):
         """
         Returns a tuple (chi squared, confident) of the experiment. Confident
-        is simply a boolean specifying whether we're > 95%% sure that the
-        results are statistically significant.
+        is simply a boolean specifying whether the results are statistically
+        significant at the given confidence level (by default, the
+        `bandit_confidence` option.)
         """
 
         choices = self.choices
@@ -207,19 +527,33 @@ class Experiment(object):
         # Get the chi-squared between the top two choices, if more than two choices exist
         if len(choices) >= 2:
             csq = chi_squared(*choices)
-            confident = is_confident(csq, len(choices)) if len(choices) <= 10 else None
+            confident = is_confident(csq, len(choices), confidence=confidence)
         else:
             csq = None
             confident = False
 
         return (csq, confident)
 
+    def p_value(self):
+        """
+        Returns the p-value of the experiment's chi squared statistic, or
+        `None` if there are fewer than two choices
+        """
+
+        choices = self.choices
+
+        if len(choices) >= 2:
+            return chi_squared_p_value(chi_squared(*choices), len(choices) - 1)
+        else:
+            return None
+
     def archive(self):
         """Archives an experiment"""
         pipe = self.redis.pipeline(transaction=True)
         pipe.srem(ACTIVE_EXPERIMENTS_REDIS_KEY, self.name)
         pipe.sadd(ARCHIVED_EXPERIMENTS_REDIS_KEY, self.name)
         pipe.execute()
+        invalidate_cached_experiment(self.name)
 
     def add_choice(self, choice_name):
         """Adds a choice for the experiment"""
@@ -231,28 +565,108 @@ class Experiment(object):
             raise ExperimentException(self.name, "Choice already exists: %s" % choice_name)
 
         self.choice_names.append(choice_name)
-        self.redis.hset(EXPERIMENT_REDIS_KEY_TEMPLATE % self.name, "choices", escape.json_encode(self.choice_names))
-        self.refresh()
+        self._save_choices()
 
     def remove_choice(self, choice_name):
         """Adds a choice for the experiment"""
 
         self.choice_names.remove(choice_name)
-        self.redis.hset(EXPERIMENT_REDIS_KEY_TEMPLATE % self.name, "choices", escape.json_encode(self.choice_names))
+        self._save_choices()
+
+    def _save_choices(self):
+        """
+        Stores the choice names, and marks the experiment as needing its
+        default choice recomputed
+        """
+
+        pipe = self.redis.pipeline(transaction=True)
+        pipe.hset(EXPERIMENT_REDIS_KEY_TEMPLATE % self.name, "choices", escape.json_encode(self.choice_names))
+        pipe.sadd(DIRTY_EXPERIMENTS_REDIS_KEY, self.name)
+        pipe.execute()
+        invalidate_cached_experiment(self.name)
         self.refresh()
 
-    def add_play(self, choice, count=1):
-        """Increments the play count for a given experiment choice"""
-        self.redis.hincrby(EXPERIMENT_REDIS_KEY_TEMPLATE % self.name, "%s:plays" % choice, count)
-        self._choices = None
+    def _increment(self, field, count, buffered, pipe):
+        """
+        Increments a counter field (and its current bucket, if bucketed
+        counters are enabled), keeping the local snapshot in sync with the
+        values redis returns. The experiment is marked as needing its default
+        choice recomputed.
+        """
+
+        fields = [field]
+        bucket = current_bucket()
+
+        if bucket != None:
+            fields.append("%s:%s" % (field, bucket))
+
+        if buffered:
+            for counter_field in fields:
+                buffer_increment(self.name, counter_field, count)
+                self.counters[counter_field] = self.counters.get(counter_field, 0) + count
+        elif pipe != None:
+            for counter_field in fields:
+                pipe.hincrby(EXPERIMENT_REDIS_KEY_TEMPLATE % self.name, counter_field, count)
+                self.counters[counter_field] = self.counters.get(counter_field, 0) + count
+
+            pipe.sadd(DIRTY_EXPERIMENTS_REDIS_KEY, self.name)
+        else:
+            pipe = self.redis.pipeline(transaction=False)
+
+            for counter_field in fields:
+                pipe.hincrby(EXPERIMENT_REDIS_KEY_TEMPLATE % self.name, counter_field, count)
+
+            pipe.sadd(DIRTY_EXPERIMENTS_REDIS_KEY, self.name)
+            self.counters.update(zip(fields, pipe.execute()))
 
-    def add_reward(self, choice, count=1):
-        """Increments the reward count for a given experiment choice"""
-        self.redis.hincrby(EXPERIMENT_REDIS_KEY_TEMPLATE % self.name, "%s:rewards" % choice, count)
         self._choices = None
 
-    def compute_default_choice(self):
-        """Computes and sets the default choice"""
+    def add_play(self, choice, count=1, buffered=False, pipe=None):
+        """
+        Increments the play count for a given experiment choice. If
+        `buffered` is set, the increment is queued in-process and written out
+        later by `flush_counters`. Otherwise, if `pipe` is specified, the
+        increment is queued on it rather than written immediately.
+        """
+        self._increment("%s:plays" % choice, count, buffered, pipe)
+
+    def add_reward(self, choice, count=1, buffered=False, pipe=None):
+        """
+        Increments the reward count for a given experiment choice. If
+        `buffered` is set, the increment is queued in-process and written out
+        later by `flush_counters`. Otherwise, if `pipe` is specified, the
+        increment is queued on it rather than written immediately.
+        """
+        self._increment("%s:rewards" % choice, count, buffered, pipe)
+
+    def prune_buckets(self, pipe=None):
+        """
+        Removes bucketed counters that are older than the retention period.
+        If `pipe` is specified, the removals are queued on it rather than
+        executed immediately.
+        """
+
+        bucket = current_bucket()
+
+        if bucket == None:
+            return
+
+        oldest_bucket = bucket - oz.settings["bandit_bucket_retention"] + 1
+        expired_fields = [key for key in self.counters.keys() if key.count(":") == 2 and int(key.rsplit(":", 1)[1]) < oldest_bucket]
+
+        if expired_fields:
+            (pipe or self.redis).hdel(EXPERIMENT_REDIS_KEY_TEMPLATE % self.name, *expired_fields)
+
+            for field in expired_fields:
+                del self.counters[field]
+
+            self._choices = None
+
+    def compute_default_choice(self, pipe=None):
+        """
+        Computes and sets the default choice. If `pipe` is specified, the
+        new default choice is queued on it rather than written immediately.
+        """
 
         choices = self.choices
 
@@ -260,43 +674,255 @@ class Experiment(object):
             return None
 
         high_choice = max(choices, key=lambda choice: choice.performance)
-        self.redis.hset(EXPERIMENT_REDIS_KEY_TEMPLATE % self.name, "default-choice", high_choice.name)
-        self.refresh()
+        (pipe or self.redis).hset(EXPERIMENT_REDIS_KEY_TEMPLATE % self.name, "default-choice", high_choice.name)
+        self.default_choice = high_choice.name
+        invalidate_cached_experiment(self.name)
         return high_choice
 
 class ExperimentChoice(object):
-    """Represents an experiment choice"""
+    """
+    Represents an experiment choice. If bucketed counters are enabled,
+    `performance` is computed from the plays and rewards within the retention
+    period, optionally weighted with an exponential decay. Otherwise it is
+    computed from the lifetime counters.
+    """
 
-    def __init__(self, experiment, name):
+    def __init__(self, experiment, name, plays=None, rewards=None, buckets=None):
         self.experiment = experiment
         self.name = name
-        self.refresh()
+
+        if plays == None or rewards == None:
+            self.refresh()
+        else:
+            self._set_counts(plays, rewards, buckets)
+
+    def _set_counts(self, plays, rewards, buckets):
+        self.plays = plays
+        self.rewards = rewards
+
+        if buckets == None:
+            self.windowed_plays = plays
+            self.windowed_rewards = rewards
+        else:
+            bucket = current_bucket()
+            retention = oz.settings["bandit_bucket_retention"]
+            half_life = oz.settings["bandit_bucket_half_life"]
+            self.windowed_plays = self.windowed_rewards = 0.0
+
+            for bucket_id, (bucket_plays, bucket_rewards) in buckets.items():
+                age = max(bucket - bucket_id, 0)
+
+                if age < retention:
+                    weight = 0.5 ** (age / half_life) if half_life else 1.0
+                    self.windowed_plays += weight * bucket_plays
+                    self.windowed_rewards += weight * bucket_rewards
+
+        self.performance = float(self.windowed_rewards) / self.windowed_plays if self.windowed_plays > 0 else 0.0
 
     def refresh(self):
         """Re-pulls the data from redis"""
+        self.experiment.refresh()
+        self._set_counts(*self.experiment._choice_counts(self.name))
 
-        redis_key = EXPERIMENT_REDIS_KEY_TEMPLATE % self.experiment.name
-        self.plays = int(self.experiment.redis.hget(redis_key, "%s:plays" % self.name) or 0)
-        self.rewards = int(self.experiment.redis.hget(redis_key, "%s:rewards" % self.name) or 0)
-        self.performance = float(self.rewards) / max(self.plays, 1)
-
-def add_experiment(redis, name):
-    """Adds a new experiment"""
+def add_experiment(redis, name, strategy=None):
+    """
+    Adds a new experiment. If `strategy` is not specified, the experiment
+    uses the default allocation strategy.
+    """
 
     if not ALLOWED_NAMES.match(name):
         raise ExperimentException(name, "Illegal name")
+    if strategy != None and strategy not in STRATEGIES:
+        raise ExperimentException(name, "Unknown strategy: %s" % strategy)
     if redis.exists(EXPERIMENT_REDIS_KEY_TEMPLATE % name):
         raise ExperimentException(name, "Already exists")
 
     json = dict(creation_date=util.unicode_type(datetime.datetime.now()))
+
+    if strategy != None:
+        json["strategy"] = strategy
+
     pipe = redis.pipeline(transaction=True)
     pipe.sadd(ACTIVE_EXPERIMENTS_REDIS_KEY, name)
     pipe.hset(EXPERIMENT_REDIS_KEY_TEMPLATE % name, "metadata", escape.json_encode(json))
     pipe.execute()
     return Experiment(redis, name)
 
+def current_bucket():
+    """
+    Returns the id of the current counter bucket, or `None` if bucketed
+    counters are disabled
+    """
+
+    bucket_seconds = oz.settings["bandit_bucket_seconds"]
+    return int(time.time() // bucket_seconds) if bucket_seconds else None
+
+def get_cached_experiment(redis, name):
+    """
+    Gets an experiment, re-using a process-local snapshot of its definition
+    if one was loaded less than `bandit_cache_ttl` seconds ago. Experiments
+    are always loaded fresh if the TTL is not set.
+    """
+
+    ttl = oz.settings["bandit_cache_ttl"]
+
+    if not ttl:
+        return Experiment(redis, name)
+
+    now = time.time()
+    cached = _experiment_cache.get(name)
+
+    if cached == None or cached[0] <= now:
+        data = redis.hgetall(EXPERIMENT_REDIS_KEY_TEMPLATE % name)
+        experiment = Experiment(redis, name, data=data)
+        _experiment_cache[name] = (now + ttl, data)
+        return experiment
+    else:
+        return Experiment(redis, name, data=cached[1])
+
+def invalidate_cached_experiment(name):
+    """Removes an experiment from the process-local experiment cache"""
+    _experiment_cache.pop(name, None)
+
+def assign_choice(redis, session_key, session_field, name, candidate, session_time=None, serialized_candidate=None):
+    """
+    Atomically opts a session into an experiment choice and adds a play for
+    that choice, in a single round trip. The choice stored in the session
+    hash at `session_key` / `session_field` is kept if it's still valid;
+    otherwise the session joins `candidate`, which is stored as
+    `serialized_candidate` if specified. The session hash expiration is
+    extended by `session_time` seconds, if set.
+
+    Returns the joined choice, or `None` if the session was not opted in.
+    """
+
+    global _assign_choice_script
+
+    if _assign_choice_script == None:
+        _assign_choice_script = redis.register_script(ASSIGN_CHOICE_SCRIPT)
+
+    keys = [session_key, EXPERIMENT_REDIS_KEY_TEMPLATE % name, DIRTY_EXPERIMENTS_REDIS_KEY]
+    bucket = current_bucket()
+    args = [session_field, candidate or "", session_time or 0, name, bucket if bucket != None else "", serialized_candidate or candidate or ""]
+    return escape.to_unicode(_assign_choice_script(keys=keys, args=args, client=redis))
+
+def buffer_increment(name, field, count=1):
+    """
+    Queues an increment of an experiment counter field. Buffered increments
+    are written out every `bandit_flush_interval` seconds by a periodic
+    callback on the current ioloop. This is safe to call from other threads,
+    such as those running `oz.redis.run_async` calls.
+    """
+
+    with _pending_counts_lock:
+        _pending_counts[(name, field)] += count
+
+    io_loop = oz.redis.current_ioloop()
+
+    if _flush_callback == None or _flush_callback[0] != io_loop:
+        io_loop.add_callback(_start_flush_callback, io_loop)
+
+def _start_flush_callback(io_loop):
+    """
+    Schedules buffered counter increments to be flushed periodically on an
+    ioloop. Must be run on that ioloop.
+    """
+
+    global _flush_callback
+
+    if _flush_callback != None:
+        if _flush_callback[0] == io_loop:
+            return
+
+        _flush_callback[1].stop()
+
+    callback = ioloop.PeriodicCallback(flush_counters, oz.settings["bandit_flush_interval"] * 1000)
+    callback.start()
+    _flush_callback = (io_loop, callback)
+
+@oz.shutdown_hook
+def flush_counters(redis=None):
+    """Writes any buffered counter increments to redis in a single pipeline"""
+
+    global _pending_counts
+
+    with _pending_counts_lock:
+        if not _pending_counts:
+            return
+
+        counts = _pending_counts
+        _pending_counts = collections.defaultdict(int)
+
+    pipe = (redis or oz.redis.create_connection("bandit")).pipeline(transaction=False)
+
+    for (name, field), count in counts.items():
+        pipe.hincrby(EXPERIMENT_REDIS_KEY_TEMPLATE % name, field, count)
+
+    pipe.sadd(DIRTY_EXPERIMENTS_REDIS_KEY, *set(name for name, _ in counts.keys()))
+
+    try:
+        pipe.execute()
+    except:
+        # Put the increments back so they are retried on the next flush
+        with _pending_counts_lock:
+            for key, count in counts.items():
+                _pending_counts[key] += count
+
+        raise
+
+def load_experiments(redis, names, skip_missing=False):
+    """
+    Loads several experiments at once, fetching all of their redis hashes in
+    a single pipeline. Experiments that do not exist are left out if
+    `skip_missing` is set; otherwise an `ExperimentException` is raised.
+    """
+
+    names = [escape.to_unicode(name) for name in names]
+    pipe = redis.pipeline(transaction=False)
+
+    for name in names:
+        pipe.hgetall(EXPERIMENT_REDIS_KEY_TEMPLATE % name)
+
+    return [
+        Experiment(redis, name, data=data)
+        for name, data in zip(names, pipe.execute())
+        if data or not skip_missing
+    ]
+
+def recompute_default_choices(redis):
+    """
+    Recomputes the default choice of every experiment whose counters or
+    choices changed since the last recomputation, writing the new defaults
+    in a single pipeline. Returns the recomputed experiments.
+    """
+
+    pipe = redis.pipeline(transaction=True)
+    pipe.smembers(DIRTY_EXPERIMENTS_REDIS_KEY)
+    pipe.delete(DIRTY_EXPERIMENTS_REDIS_KEY)
+    names = pipe.execute()[0]
+
+    if not names:
+        return []
+
+    try:
+        experiments = load_experiments(redis, names, skip_missing=True)
+        pipe = redis.pipeline(transaction=False)
+
+        for experiment in experiments:
+            experiment.prune_buckets(pipe=pipe)
+            experiment.compute_default_choice(pipe=pipe)
+
+        pipe.execute()
+    except:
+        # Mark the experiments as dirty again so they are retried on the next
+        # pass
+        redis.sadd(DIRTY_EXPERIMENTS_REDIS_KEY, *names)
+        raise
+
+    return experiments
+
 def get_experiments(redis, active=True):
     """Gets the full list of experiments"""
 
     key = ACTIVE_EXPERIMENTS_REDIS_KEY if active else ARCHIVED_EXPERIMENTS_REDIS_KEY
-    return [Experiment(redis, escape.to_unicode(name)) for name in redis.smembers(key)]
+    return load_experiments(redis, redis.smembers(key))
@@ -1,33 +1,40 @@
 from __future__ import absolute_import, division, print_function, with_statement, unicode_literals
 
 import oz
+import time
 import datetime
 import oz.redis
 import oz.bandit
 from tornado import escape
 
 @oz.action
-def add_experiment(experiment):
+def add_experiment(experiment, strategy=None):
     """Adds a new experiment"""
-    redis = oz.redis.create_connection()
-    oz.bandit.add_experiment(redis, experiment)
+    redis = oz.redis.create_connection("bandit")
+    oz.bandit.add_experiment(redis, experiment, strategy=strategy)
+
+@oz.action
+def set_experiment_strategy(experiment, strategy):
+    """Sets the allocation strategy of an experiment"""
+    redis = oz.redis.create_connection("bandit")
+    oz.bandit.Experiment(redis, experiment).set_strategy(strategy)
 
 @oz.action
 def archive_experiment(experiment):
     """Archives an experiment"""
-    redis = oz.redis.create_connection()
+    redis = oz.redis.create_connection("bandit")
     oz.bandit.Experiment(redis, experiment).archive()
 
 @oz.action
 def add_experiment_choice(experiment, choice):
     """Adds an experiment choice"""
-    redis = oz.redis.create_connection()
+    redis = oz.redis.create_connection("bandit")
     oz.bandit.Experiment(redis, experiment).add_choice(choice)
 
 @oz.action
 def remove_experiment_choice(experiment, choice):
     """Removes an experiment choice"""
-    redis = oz.redis.create_connection()
+    redis = oz.redis.create_connection("bandit")
     oz.bandit.Experiment(redis, experiment).remove_choice(choice)
 
 @oz.action
@@ -37,10 +44,16 @@ def get_experiment_results():
     out
     """
 
-    redis = oz.redis.create_connection()
+    redis = oz.redis.create_connection("bandit")
+    experiments = oz.bandit.get_experiments(redis)
+    pipe = redis.pipeline(transaction=False)
+
+    for experiment in experiments:
+        experiment.compute_default_choice(pipe=pipe)
+
+    pipe.execute()
 
-    for experiment in oz.bandit.get_experiments(redis):
-        experiment.compute_default_choice()
+    for experiment in experiments:
         csq, confident = experiment.confidence()
 
         print("%s:" % experiment.name)
@@ -48,16 +61,37 @@ def get_experiment_results():
         print("- default choice: %s" % experiment.default_choice)
         print("- chi squared: %s" % csq)
         print("- confident: %s" % confident)
+        print("- p-value: %s" % experiment.p_value())
         print("- choices:")
 
         for choice in experiment.choices:
             print("  - %s: plays=%s, rewards=%s, performance=%s" % (choice.name, choice.plays, choice.rewards, choice.performance))
 
 @oz.action
-def sync_experiments_from_spec(filename):
+def recompute_experiment_defaults(interval=None):
+    """
+    Recomputes the default choices of experiments whose results changed since
+    the last recomputation. If `interval` is specified, this runs forever,
+    recomputing every `interval` seconds.
+    """
+
+    redis = oz.redis.create_connection("bandit")
+
+    while True:
+        for experiment in oz.bandit.recompute_default_choices(redis):
+            print("%s: %s" % (experiment.name, experiment.default_choice))
+
+        if interval == None:
+            break
+
+        time.sleep(float(interval))
+
+@oz.action
+def sync_experiments_from_spec(filename, dry_run=False):
     """
     Takes the path to a JSON file declaring experiment specifications, and
-    modifies the experiments stored in redis to match the spec.
+    modifies the experiments stored in redis to match the spec. If `dry_run`
+    is set, the changes are printed but not applied.
 
     A spec looks like this:
     {
@@ -66,9 +100,14 @@ def sync_experiments_from_spec(filename):
     }
     """
 
-    redis = oz.redis.create_connection()
+    redis = oz.redis.create_connection("bandit")
 
     with open(filename, "r") as f:
         schema = escape.json_decode(f.read())
 
-    oz.bandit.sync_from_spec(redis, schema)
+    plan = oz.bandit.sync_from_spec(redis, schema, dry_run=dry_run)
+
+    if plan:
+        print(plan)
+    else:
+        print("Experiments already match the spec")
@@ -3,9 +3,10 @@
 from __future__ import absolute_import, division, print_function, with_statement, unicode_literals
 
 import oz
-import random
+import oz.redis
 import oz.bandit
-from tornado import escape
+import oz.redis_sessions
+from tornado import escape, gen
 
 class BanditTestingMiddleware(object):
     def __init__(self):
@@ -13,6 +14,20 @@ class BanditTestingMiddleware(object):
         self.template_helper("get_experiment_choice", self.get_experiment_choice)
         self.template_helper("choose_experiment", self.choose_experiment)
 
+    @property
+    def _bandit_counter_pipe(self):
+        """
+        The request's bandit batch if the handler opted into batching redis
+        writes, in which case plays and rewards are sent when the request
+        finishes. Otherwise `None`, so they're written immediately.
+        """
+        return self.redis_batch("bandit") if self.batch_redis_writes else None
+
+    @property
+    def _buffer_bandit_counters(self):
+        """Whether play/reward increments should be written out in batches"""
+        return bool(oz.settings["bandit_flush_interval"])
+
     def session_key(self, experiment):
         """Gets the session key for an experiment"""
         return "bandit:%s:v1" % experiment
@@ -29,40 +44,76 @@ class BanditTestingMiddleware(object):
         """Gets the experiment choice a user is in"""
         return escape.to_unicode(self.get_session_value(self.session_key(experiment)))
 
-    def choose_experiment(self, name):
+    def _check_atomic_choices(self):
+        """Makes sure atomic choices can see the session hash"""
+
+        if not isinstance(self, oz.redis_sessions.RedisSessionMiddleware):
+            raise Exception("bandit_atomic_choices requires sessions stored in redis by RedisSessionMiddleware")
+        if oz.redis.resolve_name("sessions") != oz.redis.resolve_name("bandit"):
+            raise Exception("bandit_atomic_choices requires sessions and bandit experiments to use the same redis connection")
+
+    def _atomic_choice_args(self, experiment):
+        """Gets the arguments for `oz.bandit.assign_choice`"""
+
+        candidate = experiment.strategy.choose(experiment)
+        serialized_candidate = oz.redis_sessions.serialize_value(candidate) if candidate else None
+        return (self.redis("bandit"), self._session_key, self.session_key(experiment.name), experiment.name, candidate, oz.settings["session_time"], serialized_candidate)
+
+    def _atomic_choice_assigned(self, name, choice):
         """
-        Opts a user into one of many choices for an experiment. They have a
-        90 percent chance of being opted into the default choice (the one with
-        the greatest results.) Otherwise they join a random choice (including
-        potentially the default choice anyway.)
+        Records a choice made by `oz.bandit.assign_choice` in the session.
+        The script already stored it and extended the session's expiration,
+        so it's set as saved, without loading the session or writing it again
+        when the request finishes.
         """
 
-        experiment = oz.bandit.Experiment(self.redis(), name)
-        choice = self.get_experiment_choice(name)
+        if choice:
+            self._session.set_saved(self.session_key(name), oz.redis_sessions.serialize_value(choice))
+            self._session_accessed()
+
+    def _pick_choice(self, experiment):
+        """
+        Gets the user's current choice for an experiment, opting them into a
+        new one if they don't have a valid choice
+        """
+
+        choice = self.get_experiment_choice(experiment.name)
 
         # If the currently selected user choice is no longer valid, nullify it
         if not choice in experiment.choice_names:
             choice = None
 
         if not choice:
-            if random.random() >= 0.1:
-                # Join the best performing choice
-                default_choice = experiment.default_choice
-
-                if default_choice:
-                    choice = default_choice
-
-            if not choice and len(experiment.choice_names) > 0:
-                # Join a random choice
-                choice = random.choice(experiment.choice_names)
+            choice = experiment.strategy.choose(experiment)
 
             # Opt the user in
             if choice:
-                self.join_experiment(name, choice)
+                self.join_experiment(experiment.name, choice)
+
+        return choice
+
+    def choose_experiment(self, name):
+        """
+        Opts a user into one of many choices for an experiment. The choice is
+        picked by the experiment's allocation strategy - by default, users
+        have a 90 percent chance of being opted into the default choice (the
+        one with the greatest results.) Otherwise they join a random choice
+        (including potentially the default choice anyway.)
+        """
+
+        experiment = oz.bandit.get_cached_experiment(self.redis("bandit"), name)
+
+        if oz.settings["bandit_atomic_choices"]:
+            self._check_atomic_choices()
+            choice = oz.bandit.assign_choice(*self._atomic_choice_args(experiment))
+            self._atomic_choice_assigned(name, choice)
+            return choice
+
+        choice = self._pick_choice(experiment)
 
         # Add to the play count for the selected choice
         if choice:
-            experiment.add_play(choice)
+            experiment.add_play(choice, buffered=self._buffer_bandit_counters, pipe=self._bandit_counter_pipe)
 
         return choice
 
@@ -72,5 +123,59 @@ class BanditTestingMiddleware(object):
         converted, or clicked-through, etc.
         """
         choice = self.get_experiment_choice(name)
-        experiment = oz.bandit.Experiment(self.redis(), name)
-        experiment.add_reward(choice)
+        experiment = oz.bandit.get_cached_experiment(self.redis("bandit"), name)
+        experiment.add_reward(choice, buffered=self._buffer_bandit_counters, pipe=self._bandit_counter_pipe)
+
+    @gen.coroutine
+    def _increment_async(self, increment, choice):
+        """
+        Adds a play or reward without blocking the ioloop. Only writes sent
+        straight to redis run in the thread pool; queued ones are added on the
+        ioloop thread. Returns a future.
+        """
+
+        buffered = self._buffer_bandit_counters
+        pipe = self._bandit_counter_pipe
+
+        if buffered or pipe != None:
+            increment(choice, buffered=buffered, pipe=pipe)
+        else:
+            yield oz.redis.run_async(increment, choice)
+
+    @gen.coroutine
+    def choose_experiment_async(self, name):
+        """
+        Opts a user into one of many choices for an experiment without
+        blocking the ioloop. Returns a future. The session, its cookie and the
+        request's batches are handled on the ioloop thread, and only the
+        redis calls run in the thread pool.
+        """
+
+        experiment = yield oz.redis.run_async(oz.bandit.get_cached_experiment, self.redis("bandit"), name)
+
+        if oz.settings["bandit_atomic_choices"]:
+            self._check_atomic_choices()
+            yield self._session_async()
+            choice = yield oz.redis.run_async(oz.bandit.assign_choice, *self._atomic_choice_args(experiment))
+            self._atomic_choice_assigned(name, choice)
+            raise gen.Return(choice)
+
+        yield self._session_async(load=True)
+        choice = self._pick_choice(experiment)
+
+        if choice:
+            yield self._increment_async(experiment.add_play, choice)
+
+        raise gen.Return(choice)
+
+    @gen.coroutine
+    def experiment_success_async(self, name):
+        """
+        Marks the user's current choice as successful without blocking the
+        ioloop. Returns a future.
+        """
+
+        yield self._session_async(load=True)
+        choice = self.get_experiment_choice(name)
+        experiment = yield oz.redis.run_async(oz.bandit.get_cached_experiment, self.redis("bandit"), name)
+        yield self._increment_async(experiment.add_reward, choice)
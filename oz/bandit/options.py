@@ -0,0 +1,15 @@
+"""Options for the bandit plugin"""
+
+from __future__ import absolute_import, division, print_function, with_statement, unicode_literals
+
+import oz
+
+oz.options(
+    bandit_confidence = dict(type=float, default=0.95, help="Confidence level at which experiment results are considered statistically significant"),
+    bandit_cache_ttl = dict(type=int, default=0, help="Number of seconds that experiment definitions are cached in-process by the bandit middleware. Changes made from other processes may take this long to be picked up. Set to 0 to disable caching."),
+    bandit_atomic_choices = dict(type=bool, default=False, help="If True, the bandit middleware opts users into experiment choices and counts plays with a single atomic redis script call. Requires RedisSessionMiddleware (not cookie sessions), with sessions stored on the same redis instance as experiments."),
+    bandit_bucket_seconds = dict(type=int, default=0, help="If set, play and reward counts are also tracked in buckets of this many seconds (e.g. 3600 for hourly buckets), and choice performance is computed from the recent buckets only. Set to 0 to compute performance from lifetime counts."),
+    bandit_bucket_retention = dict(type=int, default=24, help="Number of counter buckets used to compute choice performance. Older buckets are pruned when default choices are recomputed."),
+    bandit_bucket_half_life = dict(type=float, default=0, help="Half-life, in buckets, of the exponential decay applied to bucketed counts when computing choice performance. Set to 0 to weigh all retained buckets equally."),
+    bandit_flush_interval = dict(type=float, default=0, help="If set, play and reward increments made by the bandit middleware are buffered in-process and written to redis in a single pipeline every this many seconds, and on graceful shutdown. Set to 0 to write increments immediately."),
+)
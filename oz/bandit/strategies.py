@@ -0,0 +1,97 @@
+"""Allocation strategies for the bandit plugin"""
+
+from __future__ import absolute_import, division, print_function, with_statement, unicode_literals
+
+import math
+import random
+
+class Strategy(object):
+    """
+    Base class for algorithms that decide which choice of an experiment a new
+    user should be opted into. Strategies work off of the counters already
+    loaded in the experiment, so they never make requests to redis
+    themselves. They use the windowed (and possibly decayed) plays and
+    rewards, which are the lifetime counts unless bucketing is enabled.
+    """
+
+    def choose(self, experiment):
+        """
+        Returns the name of the choice to opt a user into, or `None` if the
+        experiment has no choices
+        """
+        raise NotImplementedError()
+
+class EpsilonGreedyStrategy(Strategy):
+    """
+    Opts users into the default choice (the one with the greatest results)
+    with a probability of 1 - `epsilon`. Otherwise they join a random choice
+    (including potentially the default choice anyway.)
+    """
+
+    def __init__(self, epsilon=0.1):
+        self.epsilon = epsilon
+
+    def choose(self, experiment):
+        if not experiment.choice_names:
+            return None
+
+        if random.random() >= self.epsilon and experiment.default_choice in experiment.choice_names:
+            return experiment.default_choice
+
+        return random.choice(experiment.choice_names)
+
+class ThompsonSamplingStrategy(Strategy):
+    """
+    Samples each choice's Beta posterior of its reward rate, and opts users
+    into the choice with the highest sample
+    """
+
+    def choose(self, experiment):
+        choices = experiment.choices
+
+        if not choices:
+            return None
+
+        samples = [(random.betavariate(choice.windowed_rewards + 1, max(choice.windowed_plays - choice.windowed_rewards, 0) + 1), choice.name) for choice in choices]
+        return max(samples)[1]
+
+class UCB1Strategy(Strategy):
+    """
+    Opts users into the choice with the highest upper confidence bound of its
+    performance. Choices that have never been played are tried first.
+
+    Each choice's exploration bonus is scaled by a random factor between
+    `1 - jitter` and `1 + jitter`. Without it, every user would get the same
+    choice until the counters change - which, with `bandit_cache_ttl` set,
+    is only once the cached experiment expires.
+    """
+
+    def __init__(self, jitter=0.5):
+        self.jitter = jitter
+
+    def choose(self, experiment):
+        choices = experiment.choices
+
+        if not choices:
+            return None
+
+        unplayed_choice_names = [choice.name for choice in choices if choice.windowed_plays <= 0]
+
+        if unplayed_choice_names:
+            return random.choice(unplayed_choice_names)
+
+        # Decayed play counts can add up to less than one
+        log_total_plays = math.log(max(sum(choice.windowed_plays for choice in choices), 1))
+        bound = lambda choice: choice.performance + math.sqrt(2 * log_total_plays / choice.windowed_plays) * random.uniform(1 - self.jitter, 1 + self.jitter)
+        return max(choices, key=bound).name
+
+# Mapping of strategy name -> strategy. Applications can add their own
+# strategies here.
+STRATEGIES = {
+    "epsilon-greedy": EpsilonGreedyStrategy(),
+    "thompson-sampling": ThompsonSamplingStrategy(),
+    "ucb1": UCB1Strategy(),
+}
+
+# The strategy used by experiments that do not specify one
+DEFAULT_STRATEGY = "epsilon-greedy"
@@ -181,6 +181,12 @@ def _shutdown_tornado_ioloop(http_srv, sig, frame):
         if now < deadline_seconds and io_loop._callbacks:
             io_loop.add_timeout(now + 1, stop_loop, deadline_seconds)
         else:
+            for hook in oz._shutdown_hooks:
+                try:
+                    hook()
+                except Exception:
+                    tornado.log.app_log.warning("Error occurred in shutdown hook", exc_info=True)
+
             io_loop.stop()
 
     def shutdown():
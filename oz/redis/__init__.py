@@ -2,36 +2,316 @@
 
 from __future__ import absolute_import, division, print_function, with_statement, unicode_literals
 
+import os
+import functools
+import threading
 import redis
+import tornado.concurrent
+import tornado.ioloop
+
+try:
+    from concurrent.futures import ThreadPoolExecutor
+except ImportError:
+    ThreadPoolExecutor = None
 
 from .middleware import *
 from .options import *
 
-_cached_connection = None
+# Mapping of connection name -> connection pool
+_pools = {}
 
-def create_connection():
-    """Sets up a redis configuration"""
+# Mapping of connection name -> cached client
+_cached_connections = {}
 
-    global _cached_connection
-    settings = oz.settings
+# Thread pool that runs redis commands for `run_async`, created lazily
+_executor = None
 
-    if settings["redis_cache_connections"] and _cached_connection != None:
-        return _cached_connection
-    else:
-        conn = redis.StrictRedis(
-            host=settings["redis_host"],
-            port=settings["redis_port"],
-            db=settings["redis_db"],
-            password=settings["redis_password"],
-            decode_responses=settings["redis_decode_responses"],
-            ssl=settings["redis_use_ssl"],
-            ssl_keyfile=settings["redis_ssl_keyfile"],
-            ssl_certfile=settings["redis_ssl_certfile"],
-            ssl_cert_reqs=settings["redis_ssl_cert_reqs"],
-            ssl_ca_certs=settings["redis_ssl_ca_certs"]
+# Thread-local state for calls made through `run_async`
+_async_context = threading.local()
+
+# ID of the process that owns the connection pools
+_pid = os.getpid()
+
+# Connection pools inherited from a parent process. These are never used, but
+# are kept referenced because garbage collecting them would shut down the
+# sockets they share with the parent on older versions of redis-py.
+_inherited_pools = []
+
+# The redis connection settings, which can be overridden per connection name
+# through the `redis_connections` option
+CONNECTION_SETTINGS = [
+    "host",
+    "port",
+    "db",
+    "password",
+    "decode_responses",
+    "max_connections",
+    "socket_timeout",
+    "socket_connect_timeout",
+    "health_check_interval",
+    "use_ssl",
+    "ssl_keyfile",
+    "ssl_certfile",
+    "ssl_cert_reqs",
+    "ssl_ca_certs",
+]
+
+def _check_fork():
+    """
+    Discards the connection pools if the process has forked since they were
+    created, so that child processes (e.g. server workers) never share sockets
+    with their parent. This checks the process ID rather than registering an
+    after-fork hook, since tornado forks workers with `os.fork` directly.
+    """
+
+    global _pid
+    global _executor
+
+    if _pid != os.getpid():
+        _pid = os.getpid()
+        _inherited_pools.extend(_pools.values())
+        _pools.clear()
+        _cached_connections.clear()
+
+        # The executor's threads do not survive the fork
+        _executor = None
+
+def resolve_name(name=None):
+    """
+    Resolves a connection name to the name of the connection pool that backs
+    it. Names that have not been configured through the `redis_connections`
+    option share the default connection pool, which is named `None`.
+    """
+    return name if name in (oz.settings["redis_connections"] or {}) else None
+
+def connection_settings(name=None):
+    """Gets the connection settings of a named connection"""
+
+    settings = dict((key, oz.settings["redis_%s" % key]) for key in CONNECTION_SETTINGS)
+    resolved_name = resolve_name(name)
+
+    if resolved_name != None:
+        settings.update(oz.settings["redis_connections"][resolved_name])
+
+    return settings
+
+def create_pool(name=None):
+    """Creates a new connection pool for a named connection"""
+
+    settings = connection_settings(name)
+    kwargs = dict(
+        host=settings["host"],
+        port=settings["port"],
+        db=settings["db"],
+        password=settings["password"],
+        decode_responses=settings["decode_responses"],
+        socket_timeout=settings["socket_timeout"],
+        socket_connect_timeout=settings["socket_connect_timeout"],
+    )
+
+    if settings["max_connections"]:
+        kwargs["max_connections"] = settings["max_connections"]
+
+    # Only supported by newer versions of redis-py, so it's only passed in
+    # when needed
+    if settings["health_check_interval"]:
+        kwargs["health_check_interval"] = settings["health_check_interval"]
+
+    if settings["use_ssl"]:
+        kwargs.update(
+            connection_class=redis.SSLConnection,
+            ssl_keyfile=settings["ssl_keyfile"],
+            ssl_certfile=settings["ssl_certfile"],
+            ssl_cert_reqs=settings["ssl_cert_reqs"],
+            ssl_ca_certs=settings["ssl_ca_certs"]
         )
 
-        if settings["redis_cache_connections"]:
-            _cached_connection = conn
+    return redis.ConnectionPool(**kwargs)
+
+def create_connection(name=None):
+    """
+    Sets up a redis configuration. `name` optionally specifies which of the
+    connections configured through the `redis_connections` option to use
+    (e.g. "sessions", "bandit" or "cdn".) Unconfigured names use the default
+    connection.
+    """
+
+    _check_fork()
+    name = resolve_name(name)
+
+    if oz.settings["redis_cache_connections"]:
+        if name not in _cached_connections:
+            _pools[name] = create_pool(name)
+            _cached_connections[name] = redis.StrictRedis(connection_pool=_pools[name])
+
+        return _cached_connections[name]
+    else:
+        return redis.StrictRedis(connection_pool=create_pool(name))
+
+def run_async(fun, *args, **kwargs):
+    """
+    Runs a blocking function (typically one making redis calls) in a thread
+    pool, so that it doesn't block the ioloop. Returns a future that resolves
+    on the current ioloop.
+    """
+
+    global _executor
+
+    if ThreadPoolExecutor == None:
+        raise Exception("Async redis calls are not supported in this environment as the futures package is not installed")
+
+    _check_fork()
+
+    if _executor == None:
+        _executor = ThreadPoolExecutor(oz.settings["redis_async_workers"])
+
+    io_loop = tornado.ioloop.IOLoop.current()
+    future = tornado.concurrent.Future()
+
+    def run():
+        _async_context.io_loop = io_loop
+
+        try:
+            return fun(*args, **kwargs)
+        finally:
+            _async_context.io_loop = None
+
+    # Resolve the returned future from the ioloop thread rather than the pool
+    # thread, since tornado futures are not thread-safe
+    io_loop.add_future(
+        _executor.submit(run),
+        lambda concurrent_future: tornado.concurrent.chain_future(concurrent_future, future)
+    )
+
+    return future
+
+def current_ioloop():
+    """
+    Gets the current ioloop. When called from a function run through
+    `run_async`, this is the ioloop that made the call.
+    """
+    return getattr(_async_context, "io_loop", None) or tornado.ioloop.IOLoop.current()
+
+class AsyncRedis(object):
+    """
+    Wraps a redis client so that its commands run in a thread pool and return
+    futures, which can be yielded from or awaited in coroutines
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def __getattr__(self, name):
+        attr = getattr(self.client, name)
+
+        if not callable(attr):
+            return attr
+
+        @functools.wraps(attr)
+        def wrapper(*args, **kwargs):
+            return run_async(attr, *args, **kwargs)
+
+        return wrapper
+
+    def pipeline(self, *args, **kwargs):
+        """
+        Creates a pipeline. Commands are queued as usual; only `execute`
+        returns a future.
+        """
+        return AsyncPipeline(self.client.pipeline(*args, **kwargs))
+
+class AsyncPipeline(object):
+    """A redis pipeline whose `execute` runs in a thread pool"""
+
+    def __init__(self, pipe):
+        self.pipe = pipe
+
+    def __getattr__(self, name):
+        return getattr(self.pipe, name)
+
+    def execute(self, *args, **kwargs):
+        return run_async(self.pipe.execute, *args, **kwargs)
+
+class RequestBatch(object):
+    """
+    Request-scoped facade over a redis client. Fire-and-forget writes (e.g.
+    `hincrby`, `expire`, `hset`) are queued and sent in a single pipeline by
+    `flush`, which `RedisMiddleware` calls when the request finishes. Queued
+    writes return `None`. Reads registered with `prefetch` are fetched
+    together in a single pipeline. Other commands, including the reads made
+    by the built-in plugins, go straight to the client.
+    """
+
+    # Commands that are queued rather than sent immediately
+    WRITE_COMMANDS = frozenset([
+        "delete",
+        "expire",
+        "hdel",
+        "hincrby",
+        "hmset",
+        "hset",
+        "incr",
+        "incrby",
+        "sadd",
+        "set",
+        "srem",
+    ])
+
+    def __init__(self, client):
+        self.client = client
+        self._writes = client.pipeline(transaction=False)
+        self._pending_prefetches = []
+        self._prefetched = {}
+
+    def __getattr__(self, name):
+        if name in self.WRITE_COMMANDS:
+            command = getattr(self._writes, name)
+
+            # Queued writes have no result yet, so don't hand back the
+            # pipeline as if it were one
+            def queue(*args, **kwargs):
+                command(*args, **kwargs)
+
+            return queue
+        else:
+            return getattr(self.client, name)
+
+    def prefetch(self, command, *args):
+        """
+        Registers a read to be fetched along with the other prefetched reads.
+        Get the result with `get_prefetched`.
+        """
+
+        key = (command,) + args
+
+        if key not in self._prefetched and key not in self._pending_prefetches:
+            self._pending_prefetches.append(key)
+
+    def fetch_prefetches(self):
+        """Fetches all of the pending prefetched reads in a single pipeline"""
+
+        if self._pending_prefetches:
+            keys = self._pending_prefetches
+            self._pending_prefetches = []
+            pipe = self.client.pipeline(transaction=False)
+
+            for key in keys:
+                getattr(pipe, key[0])(*key[1:])
+
+            self._prefetched.update(zip(keys, pipe.execute()))
+
+    def get_prefetched(self, command, *args):
+        """
+        Gets the result of a prefetched read. Reads that were never
+        registered are fetched in the same pipeline as any pending prefetches.
+        """
+
+        self.prefetch(command, *args)
+        self.fetch_prefetches()
+        return self._prefetched[(command,) + args]
+
+    def flush(self):
+        """Sends all of the queued writes in a single pipeline"""
 
-        return conn
+        if len(self._writes) > 0:
+            self._writes.execute()
@@ -2,12 +2,76 @@
 
 from __future__ import absolute_import, division, print_function, with_statement, unicode_literals
 
+import sys
+
+import tornado.log
+
 import oz
 import oz.redis
 
 class RedisMiddleware(object):
     """Adds a redis connection to the RequestHandler"""
 
-    def redis(self):
-        """Gets or creates a connection to the redis database"""
-        return oz.redis.create_connection()
+    # Whether the built-in plugins should queue their fire-and-forget writes
+    # (e.g. bandit plays) on the request's batches, rather than sending them
+    # immediately. Handlers opt in by setting this to `True`; queued writes
+    # are lost if the request never finishes.
+    batch_redis_writes = False
+
+    def __init__(self):
+        super(RedisMiddleware, self).__init__()
+        self.trigger_listener("prepare", self._redis_on_prepare)
+        self.trigger_listener("on_finish", self._redis_on_finish)
+
+    def redis(self, name=None):
+        """
+        Gets or creates a connection to the redis database. `name` optionally
+        specifies which of the connections configured through the
+        `redis_connections` option to use.
+        """
+        return oz.redis.create_connection(name)
+
+    def redis_async(self, name=None):
+        """
+        Gets a connection to the redis database whose commands return futures
+        rather than blocking the ioloop, for use in coroutine handlers. e.g.
+        `value = yield self.redis_async().get("foo")`.
+        """
+        return oz.redis.AsyncRedis(self.redis(name))
+
+    def redis_batch(self, name=None):
+        """
+        Gets the request-scoped `oz.redis.RequestBatch` for a connection.
+        Writes made through it are sent in a single pipeline when the request
+        finishes. Reads registered with its `prefetch` before the request is
+        prepared (e.g. in `initialize`) are fetched in a single pipeline then;
+        ones registered later are fetched on the next `get_prefetched`.
+        """
+
+        if not hasattr(self, "_redis_batches"):
+            self._redis_batches = {}
+
+        name = oz.redis.resolve_name(name)
+
+        if name not in self._redis_batches:
+            self._redis_batches[name] = oz.redis.RequestBatch(self.redis(name))
+
+        return self._redis_batches[name]
+
+    def _redis_on_prepare(self):
+        """Fetches any reads that were registered for prefetching"""
+
+        if hasattr(self, "_redis_batches"):
+            for batch in self._redis_batches.values():
+                batch.fetch_prefetches()
+
+    def _redis_on_finish(self):
+        """Sends the writes queued in the request's redis batches"""
+
+        if hasattr(self, "_redis_batches"):
+            for batch in self._redis_batches.values():
+                try:
+                    batch.flush()
+                except:
+                    tornado.log.app_log.warning("Error occurred when flushing queued redis writes: %s", str(sys.exc_info()[0]))
+                    raise
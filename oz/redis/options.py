@@ -5,12 +5,18 @@ from __future__ import absolute_import, division, print_function, with_statement
 import oz
 
 oz.options(
-    redis_cache_connections=dict(type=bool, default=True, help="Whether to cache the redis connection between requests to prevent TCP slow start"),
+    redis_cache_connections=dict(type=bool, default=True, help="Whether to cache redis connection pools between requests to prevent TCP slow start"),
     redis_host=dict(type=str, default="localhost", help="Redis host"),
     redis_port=dict(type=int, default=6379, help="Redis port"),
     redis_db=dict(type=int, default=0, help="Redis database number"),
     redis_password=dict(type=str, default=None, help="Password to the redis database"),
     redis_decode_responses=dict(type=bool, default=False, help="Whether to decode redis responses automatically. Keep this False if you're handling binary data in redis."),
+    redis_max_connections=dict(type=int, default=None, help="Maximum number of connections in each redis connection pool. Unlimited by default."),
+    redis_socket_timeout=dict(type=float, default=None, help="Number of seconds to wait for a response from redis before timing out"),
+    redis_socket_connect_timeout=dict(type=float, default=None, help="Number of seconds to wait while connecting to redis before timing out"),
+    redis_health_check_interval=dict(type=int, default=0, help="If set, idle redis connections are health checked when they are this many seconds old. Requires redis-py >= 3.3."),
+    redis_connections=dict(type=dict, default={}, help="Mapping of connection name -> dict of overrides for the redis options (without the 'redis_' prefix), e.g. {'sessions': {'host': 'sessions.example.com'}}. Built-in plugins use the 'sessions', 'bandit' and 'cdn' connection names; unconfigured names use the default connection."),
+    redis_async_workers=dict(type=int, default=10, help="Number of threads used to run redis commands issued through the async helpers (e.g. `redis_async`)"),
     redis_use_ssl=dict(type=bool, default=False, help="Set to True to enable SSL in redis (rediss)."),
     redis_ssl_certfile=dict(type=str, default=None, help="Set to path of client certificate, if needed."),
     redis_ssl_keyfile=dict(type=str, default=None, help="Set to path of client (private) key, if needed."),
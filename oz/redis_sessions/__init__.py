@@ -3,10 +3,21 @@
 from __future__ import absolute_import, division, print_function, with_statement, unicode_literals
 
 import os
+import json
+import zlib
 import binascii
+import time
 import hashlib
-from tornado import escape
+import threading
+import collections
+from tornado import escape, util
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+from .actions import *
 from .middleware import *
 from .options import *
 
@@ -19,3 +30,531 @@ def password_hash(password, password_salt=None):
     password_salt = password_salt or oz.settings["session_salt"]
     salted_password = password_salt + password
     return "sha256!%s" % hashlib.sha256(salted_password.encode("utf-8")).hexdigest()
+
+# Redis key template for sessions, formatted with the hashed session ID and
+# the key version
+SESSION_KEY_TEMPLATE = "session:%s:%s"
+SESSION_KEY_VERSION = "v4"
+
+# LRU mapping of (salt, session ID) -> redis key
+_session_keys = collections.OrderedDict()
+_session_keys_lock = threading.Lock()
+
+# Session hash field that holds when the session expiration was last
+# extended. It's kept out of the session values that are exposed to users.
+TOUCHED_FIELD = "_oz_touched"
+
+# Markers for the format of cookie session payloads
+COOKIE_SESSION_JSON = b"j"
+COOKIE_SESSION_ZLIB = b"z"
+COOKIE_SESSION_REDIS = b"r"
+
+# Prefixes of serialized session values. Values without one of these are raw.
+SERIALIZED_MARKER = b"\x00"
+SERIALIZED_JSON = b"\x00j"
+SERIALIZED_MSGPACK = b"\x00m"
+SERIALIZED_ZLIB = b"\x00z"
+
+def session_key(session_id, password_salt=None):
+    """
+    Gets the redis key for a session ID. Keys are kept in an LRU cache of up
+    to `session_key_cache_size` entries so that the ID doesn't have to be
+    hashed again on every request.
+    """
+
+    password_salt = password_salt or oz.settings["session_salt"]
+    cache_size = oz.settings["session_key_cache_size"]
+    cache_key = (password_salt, session_id)
+
+    with _session_keys_lock:
+        key = _session_keys.pop(cache_key, None)
+
+        if key != None:
+            _session_keys[cache_key] = key
+            return key
+
+    key = SESSION_KEY_TEMPLATE % (password_hash(session_id, password_salt=password_salt), SESSION_KEY_VERSION)
+
+    if cache_size > 0:
+        with _session_keys_lock:
+            _session_keys[cache_key] = key
+
+            while len(_session_keys) > cache_size:
+                _session_keys.popitem(last=False)
+
+    return key
+
+def encode_value(value):
+    """
+    Encodes a session value the way redis-py does when writing it, so values
+    read back within a request match those read from redis later
+    """
+
+    if isinstance(value, bytes):
+        return value
+    elif isinstance(value, util.unicode_type):
+        return value.encode("utf-8")
+    elif isinstance(value, float):
+        return escape.utf8(repr(value))
+    else:
+        return escape.utf8(str(value))
+
+def serialize_value(value, serializer=None, compress_threshold=None):
+    """
+    Serializes a session value with the `session_serializer` format - one
+    of `raw`, `json` or `msgpack`. Serialized values larger than
+    `session_compress_threshold` bytes are compressed.
+    """
+
+    serializer = serializer or oz.settings["session_serializer"]
+
+    if compress_threshold == None:
+        compress_threshold = oz.settings["session_compress_threshold"]
+
+    if serializer == "raw":
+        serialized = encode_value(value)
+    elif serializer == "json":
+        serialized = SERIALIZED_JSON + json.dumps(value, separators=(",", ":")).encode("utf-8")
+    elif serializer == "msgpack":
+        if msgpack == None:
+            raise Exception("The msgpack session serializer requires the msgpack package")
+
+        serialized = SERIALIZED_MSGPACK + msgpack.packb(value, use_bin_type=True)
+    else:
+        raise Exception("Unknown session serializer: %s" % serializer)
+
+    if compress_threshold and len(serialized) > compress_threshold:
+        compressed = SERIALIZED_ZLIB + zlib.compress(serialized)
+
+        if len(compressed) < len(serialized):
+            return compressed
+
+    return serialized
+
+def deserialize_value(value):
+    """
+    Deserializes a session value serialized by `serialize_value`. Raw values
+    are returned as-is. Values that redis has already decoded to strings
+    (with `redis_decode_responses` on) are encoded back to bytes before
+    being deserialized, which works for the `json` serializer.
+    """
+
+    if value is None:
+        return value
+    elif isinstance(value, util.unicode_type):
+        encoded = value.encode("utf-8")
+    else:
+        encoded = value
+
+    if not encoded.startswith(SERIALIZED_MARKER):
+        return value
+
+    marker, serialized = encoded[:2], encoded[2:]
+
+    if marker == SERIALIZED_ZLIB:
+        return deserialize_value(zlib.decompress(serialized))
+    elif marker == SERIALIZED_JSON:
+        return json.loads(serialized.decode("utf-8"))
+    elif marker == SERIALIZED_MSGPACK:
+        if msgpack == None:
+            raise Exception("The msgpack session serializer requires the msgpack package")
+
+        return msgpack.unpackb(serialized, raw=False)
+    else:
+        return value
+
+def parse_touched(value):
+    """
+    Parses a stored `TOUCHED_FIELD` value, returning `None` if it's missing or
+    invalid
+    """
+
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+class RedisSession(object):
+    """
+    A session stored in a redis hash. The whole hash is loaded with a single
+    `HGETALL` the first time a value is read. Changes are tracked locally,
+    without needing the hash to be loaded, and written back in one go by
+    `save`.
+    """
+
+    def __init__(self, redis, key):
+        self.redis = redis
+        self.key = key
+        self.accessed = False
+        self.cleared = False
+        self.touched = None
+        self._data = None
+        self._saved = {}
+        self._updates = {}
+        self._deleted = set()
+
+    @property
+    def data(self):
+        """Mapping of session value name -> value, loaded lazily"""
+
+        if self._data == None:
+            self.load({} if self.cleared else self.fetch())
+
+        self.accessed = True
+        return self._data
+
+    @property
+    def loaded(self):
+        """Whether the session hash has been loaded"""
+        return self._data != None
+
+    def fetch(self):
+        """
+        Reads the session hash from redis without changing the session, so
+        that it's safe to run in another thread. Pass the result to `load`.
+        """
+        return self.redis.hgetall(self.key)
+
+    def load(self, values):
+        """
+        Sets the session data from the hash read by `fetch`, keeping the
+        changes made since. Does nothing if the session is already loaded.
+        """
+
+        if self._data != None:
+            return
+
+        self._data = {}
+
+        if not self.cleared:
+            for name, value in values.items():
+                name = escape.to_unicode(name)
+
+                if name == TOUCHED_FIELD:
+                    self.touched = parse_touched(value)
+                else:
+                    self._data[name] = value
+
+            # Apply the changes made before the session was loaded
+            self._data.update(self._saved)
+            self._data.update(self._updates)
+
+            for name in self._deleted:
+                self._data.pop(name, None)
+
+    @property
+    def modified(self):
+        """Whether there are changes that have not been saved"""
+        return self.cleared or bool(self._updates) or bool(self._deleted)
+
+    def get(self, name, default=None):
+        """Gets a session value"""
+
+        if name in self._updates:
+            self.accessed = True
+            return self._updates[name]
+        elif name in self._deleted:
+            self.accessed = True
+            return default
+        elif name in self._saved:
+            return self._saved[name]
+        else:
+            return self.data.get(name, default)
+
+    def set(self, name, value):
+        """Sets a session value"""
+
+        value = encode_value(value)
+        self.accessed = True
+        self._updates[name] = value
+        self._deleted.discard(name)
+
+        if self._data != None:
+            self._data[name] = value
+
+    def set_saved(self, name, value):
+        """
+        Sets a session value that has already been written to redis by some
+        other means. The session isn't loaded for it, and it isn't written
+        again or counted as an access when the session is saved.
+        """
+
+        value = encode_value(value)
+        self._updates.pop(name, None)
+        self._deleted.discard(name)
+
+        if self._data != None:
+            self._data[name] = value
+        else:
+            self._saved[name] = value
+
+    def delete(self, name):
+        """Removes a session value"""
+
+        self.accessed = True
+        self._updates.pop(name, None)
+        self._deleted.add(name)
+
+        if self._data != None:
+            self._data.pop(name, None)
+
+    def clear(self):
+        """Removes all of the session values"""
+        self.cleared = True
+        self.accessed = True
+        self.touched = None
+        self._data = {}
+        self._saved.clear()
+        self._updates.clear()
+        self._deleted.clear()
+
+    def needs_refresh(self, session_time, refresh_fraction=0):
+        """
+        Checks whether the session expiration should be extended. If
+        `refresh_fraction` is set, this is only the case when that fraction of
+        `session_time` has elapsed since the expiration was last extended, or
+        when it was never recorded, e.g. because the session is new. Sessions
+        that haven't been loaded are always extended, since checking would
+        take an extra round trip.
+        """
+
+        if not refresh_fraction or self._data == None or self.touched == None:
+            return True
+
+        return time.time() - self.touched >= session_time * refresh_fraction
+
+    def save(self, pipe, session_time=None, refresh_fraction=0):
+        """
+        Queues the session changes, along with an `EXPIRE` if the session
+        was accessed and its expiration needs extending, on the given pipeline
+        """
+
+        if self.cleared:
+            pipe.delete(self.key)
+
+        if self._updates:
+            pipe.hmset(self.key, self._updates)
+
+        if self._deleted and not self.cleared:
+            pipe.hdel(self.key, *self._deleted)
+
+        # Sessions that were never loaded might exist in redis, but ones that
+        # were loaded and are empty don't
+        exists = bool(self._updates) or self._data == None or bool(self._data)
+
+        if session_time and self.accessed and exists and self.needs_refresh(session_time, refresh_fraction):
+            if refresh_fraction:
+                self.touched = time.time()
+                pipe.hset(self.key, TOUCHED_FIELD, encode_value(self.touched))
+
+            pipe.expire(self.key, session_time)
+
+        self.cleared = False
+        self.accessed = False
+        self._updates.clear()
+        self._deleted.clear()
+
+class CookieSession(RedisSession):
+    """
+    A session whose values are stored in a cookie rather than redis. The
+    values are (de)serialized with `encode_cookie_session` and
+    `decode_cookie_session`.
+    """
+
+    def __init__(self, data=None):
+        super(CookieSession, self).__init__(None, None)
+        self._data = dict(data or {})
+        self.touched = parse_touched(self._data.pop(TOUCHED_FIELD, None))
+
+def encode_cookie_session(data, compress_threshold=0):
+    """
+    Encodes session values for storage in a cookie. The payload is compressed
+    if it's larger than `compress_threshold` bytes and compression helps.
+    """
+
+    payload = json.dumps(
+        dict((name, value.decode("latin-1")) for name, value in data.items()),
+        separators=(",", ":"),
+        sort_keys=True,
+    ).encode("utf-8")
+
+    if compress_threshold and len(payload) > compress_threshold:
+        compressed = zlib.compress(payload)
+
+        if len(compressed) < len(payload):
+            return COOKIE_SESSION_ZLIB + compressed
+
+    return COOKIE_SESSION_JSON + payload
+
+def decode_cookie_session(payload):
+    """Decodes session values encoded by `encode_cookie_session`"""
+
+    marker, payload = payload[:1], payload[1:]
+
+    if marker == COOKIE_SESSION_ZLIB:
+        marker, payload = COOKIE_SESSION_JSON, zlib.decompress(payload)
+
+    if marker != COOKIE_SESSION_JSON:
+        raise ValueError("Unknown cookie session format")
+
+    data = json.loads(payload.decode("utf-8"))
+    return dict((name, value.encode("latin-1")) for name, value in data.items())
+
+def scan_sessions(redis, version=SESSION_KEY_VERSION, batch_size=100, sleep=0):
+    """
+    Iterates over the session keys of a given version with `SCAN`, yielding
+    lists of up to `batch_size` keys. Sleeps `sleep` seconds between batches
+    to limit the load on the redis instance.
+    """
+
+    batch = []
+
+    for key in redis.scan_iter(match=SESSION_KEY_TEMPLATE % ("*", version), count=batch_size):
+        batch.append(key)
+
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+
+            if sleep:
+                time.sleep(sleep)
+
+    if batch:
+        yield batch
+
+def session_stats(redis, version=SESSION_KEY_VERSION, batch_size=100, sleep=0):
+    """
+    Gathers statistics on the sessions of a given version: the number of
+    sessions, values (not counting `TOUCHED_FIELD`), sessions without an
+    expiration, and the total memory used. Memory usage is `None` if the redis server doesn't support
+    `MEMORY USAGE`.
+    """
+
+    stats = dict(sessions=0, values=0, persistent=0, memory=0)
+
+    for keys in scan_sessions(redis, version=version, batch_size=batch_size, sleep=sleep):
+        pipe = redis.pipeline(transaction=False)
+
+        for key in keys:
+            pipe.hlen(key)
+            pipe.hexists(key, TOUCHED_FIELD)
+            pipe.ttl(key)
+
+            if stats["memory"] != None:
+                pipe.execute_command("MEMORY", "USAGE", key)
+
+        results = pipe.execute(raise_on_error=False)
+        step = 4 if stats["memory"] != None else 3
+
+        for i in range(0, len(results), step):
+            fields, touched, ttl = results[i:i + 3]
+
+            # Skip sessions that expired while scanning
+            if not fields:
+                continue
+
+            stats["sessions"] += 1
+            stats["values"] += fields - int(touched)
+
+            if ttl == -1:
+                stats["persistent"] += 1
+
+            if step == 4:
+                if isinstance(results[i + 3], Exception):
+                    stats["memory"] = None
+                else:
+                    stats["memory"] += results[i + 3] or 0
+
+    return stats
+
+def purge_sessions(redis, version=SESSION_KEY_VERSION, persistent=False, touched_before=None, field=None, batch_size=100, sleep=0, dry_run=False, session_time=None):
+    """
+    Deletes the sessions of a given version that match all of the specified
+    criteria:
+
+    * `persistent`: the session has no expiration
+    * `touched_before`: the session's expiration was last extended before
+      this timestamp, per its `_oz_touched` field. That field is only
+      written with `session_refresh_fraction` set, so for sessions without
+      it, this is worked out from their TTL and `session_time` instead.
+    * `field`: the session has a value with this name
+
+    If `dry_run` is set, matching sessions are counted but not deleted.
+    Returns the number of matching sessions.
+    """
+
+    purged = 0
+
+    for keys in scan_sessions(redis, version=version, batch_size=batch_size, sleep=sleep):
+        pipe = redis.pipeline(transaction=False)
+
+        for key in keys:
+            pipe.ttl(key)
+            pipe.hget(key, TOUCHED_FIELD)
+
+            if field != None:
+                pipe.hexists(key, field)
+
+        results = pipe.execute()
+        step = 3 if field != None else 2
+        now = time.time()
+        matches = []
+
+        for i, key in enumerate(keys):
+            ttl, touched = results[i * step], results[i * step + 1]
+
+            # Skip sessions that expired while scanning
+            if ttl == -2:
+                continue
+            if persistent and ttl != -1:
+                continue
+
+            if touched != None:
+                touched = float(touched)
+            elif session_time and ttl >= 0:
+                # The expiration was last extended to `session_time` seconds
+                # from then
+                touched = now - (session_time - ttl)
+
+            if touched_before != None and (touched == None or touched >= touched_before):
+                continue
+            if field != None and not results[i * step + 2]:
+                continue
+
+            matches.append(key)
+
+        if matches and not dry_run:
+            redis.delete(*matches)
+
+        purged += len(matches)
+
+    return purged
+
+def migrate_sessions(redis, from_version, to_version=SESSION_KEY_VERSION, batch_size=100, sleep=0, dry_run=False):
+    """
+    Renames the sessions of one key version to another with `RENAMENX`, so
+    sessions that already exist under the new version are left alone.
+    Returns a tuple of the number of migrated and skipped sessions.
+    """
+
+    prefix, suffix = SESSION_KEY_TEMPLATE.split("%s", 1)[0], ":%s" % from_version
+    migrated = skipped = 0
+
+    for keys in scan_sessions(redis, version=from_version, batch_size=batch_size, sleep=sleep):
+        if dry_run:
+            migrated += len(keys)
+            continue
+
+        pipe = redis.pipeline(transaction=False)
+
+        for key in keys:
+            session_hash = escape.to_unicode(key)[len(prefix):-len(suffix)]
+            pipe.renamenx(key, SESSION_KEY_TEMPLATE % (session_hash, to_version))
+
+        for result in pipe.execute(raise_on_error=False):
+            if result == True:
+                migrated += 1
+            else:
+                skipped += 1
+
+    return migrated, skipped
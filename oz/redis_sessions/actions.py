@@ -0,0 +1,88 @@
+"""Actions for the redis sessions plugin"""
+
+from __future__ import absolute_import, division, print_function, with_statement, unicode_literals
+
+import oz
+import time
+import oz.redis
+import oz.redis_sessions
+
+@oz.action
+def session_stats(version=None, batch_size=100, sleep=None):
+    """
+    Prints the number of sessions, values, sessions without an expiration and
+    the memory they use. Sessions are scanned in batches of `batch_size`,
+    sleeping `sleep` seconds between batches.
+    """
+
+    redis = oz.redis.create_connection("sessions")
+    stats = oz.redis_sessions.session_stats(
+        redis,
+        version=version or oz.redis_sessions.SESSION_KEY_VERSION,
+        batch_size=int(batch_size),
+        sleep=float(sleep or 0),
+    )
+
+    print("sessions: %s" % stats["sessions"])
+    print("values: %s" % stats["values"])
+    print("without expiration: %s" % stats["persistent"])
+
+    if stats["memory"] == None:
+        print("memory: unavailable")
+    else:
+        print("memory: %s bytes" % stats["memory"])
+
+@oz.action
+def purge_sessions(version=None, persistent=False, idle_seconds=None, field=None, batch_size=100, sleep=None, dry_run=False):
+    """
+    Deletes sessions matching all of the specified criteria: `persistent`
+    sessions have no expiration, `idle_seconds` matches sessions whose
+    expiration hasn't been extended in that many seconds, and `field` matches
+    sessions with a value of that name. If `dry_run` is set, matching sessions
+    are counted but not deleted.
+    """
+
+    if not persistent and idle_seconds == None and field == None:
+        print("At least one of persistent, idle_seconds or field must be specified")
+        return -1
+
+    if idle_seconds != None and not oz.settings["session_time"]:
+        print("idle_seconds requires session_time to be set, since sessions without an expiration don't record when they were last used")
+        return -1
+
+    if idle_seconds != None and not oz.settings["session_refresh_fraction"]:
+        print("Warning: session_refresh_fraction is not set, so idle time is worked out from each session's TTL, assuming session_time hasn't changed")
+
+    redis = oz.redis.create_connection("sessions")
+    purged = oz.redis_sessions.purge_sessions(
+        redis,
+        version=version or oz.redis_sessions.SESSION_KEY_VERSION,
+        persistent=persistent,
+        touched_before=time.time() - float(idle_seconds) if idle_seconds != None else None,
+        field=field,
+        batch_size=int(batch_size),
+        sleep=float(sleep or 0),
+        dry_run=dry_run,
+        session_time=oz.settings["session_time"],
+    )
+
+    print("%s sessions %s" % (purged, "match" if dry_run else "purged"))
+
+@oz.action
+def migrate_sessions(from_version, to_version=None, batch_size=100, sleep=None, dry_run=False):
+    """
+    Moves sessions stored under an old key version to a new one (by default,
+    the current version)
+    """
+
+    redis = oz.redis.create_connection("sessions")
+    migrated, skipped = oz.redis_sessions.migrate_sessions(
+        redis,
+        from_version,
+        to_version=to_version or oz.redis_sessions.SESSION_KEY_VERSION,
+        batch_size=int(batch_size),
+        sleep=float(sleep or 0),
+        dry_run=dry_run,
+    )
+
+    print("%s sessions %s, %s skipped" % (migrated, "to migrate" if dry_run else "migrated", skipped))
@@ -2,15 +2,163 @@
 
 from __future__ import absolute_import, division, print_function, with_statement, unicode_literals
 
+import time
+
+import tornado.log
+
 import oz
+import oz.redis
 import oz.redis_sessions
+from tornado import gen
+
+class _SessionMiddleware(object):
+    """
+    The session API shared by the session middleware, built on the `_session`
+    accessor that each of them provides
+    """
+
+    def __init__(self):
+        super(_SessionMiddleware, self).__init__()
+        self.trigger_listener("on_finish", self._save_session)
+
+    def _save_session(self):
+        """
+        Writes the changes to redis-backed sessions, and updates them to
+        expire later since they have been interacted with recently. With
+        `session_refresh_fraction` set, the expiration is only extended once
+        that fraction of `session_time` has passed since it was last extended.
+        Changes go out with the sessions batch if the handler opted into
+        batching redis writes, and in their own pipeline otherwise.
+        """
+
+        session = getattr(self, "_cached_session", None)
+
+        if session == None or isinstance(session, oz.redis_sessions.CookieSession):
+            return
+
+        if self.batch_redis_writes:
+            pipe = self.redis_batch("sessions")
+        else:
+            pipe = self.redis("sessions").pipeline(transaction=False)
+
+        session.save(pipe, oz.settings["session_time"], oz.settings["session_refresh_fraction"])
+
+        if self.batch_redis_writes:
+            pipe.flush()
+        else:
+            pipe.execute()
+
+    def _session_changed(self):
+        """Called after a session value is set or removed"""
+        pass
+
+    def _session_accessed(self):
+        """
+        Called after the session is read or changed. The first time, the
+        session cookie is sent again if the session's expiration is going to
+        be extended, so that the cookie expires along with it. This is checked
+        after the access, rather than when the session is set up, so that it
+        doesn't load sessions that are only written.
+        """
+
+        if getattr(self, "_session_cookie_checked", False):
+            return
+
+        self._session_cookie_checked = True
+        session_time = oz.settings["session_time"]
+
+        if session_time and self._cached_session.needs_refresh(session_time, oz.settings["session_refresh_fraction"]):
+            self._refresh_session_cookie()
+
+    def get_session_value(self, name, default=None):
+        """Gets a session value"""
+        value = self._session.get(name)
+        self._session_accessed()
+        return default if not value else oz.redis_sessions.deserialize_value(value)
+
+    def set_session_value(self, name, value):
+        """Sets a session value"""
+        self._session.set(name, oz.redis_sessions.serialize_value(value))
+        self._session_changed()
+        self._session_accessed()
+
+    def clear_session_value(self, name):
+        """Removes a session value"""
+        self._session.delete(name)
+        self._session_changed()
+        self._session_accessed()
+
+    @property
+    def _session(self):
+        """
+        Gets the session object, which is set up on first access and saved
+        when the request finishes
+        """
+
+        if not hasattr(self, "_cached_session"):
+            self._cached_session = self._create_session()
+
+        return self._cached_session
+
+    @gen.coroutine
+    def _session_async(self, load=False):
+        """
+        Gets the session object without blocking the ioloop. Returns a future.
+        The session is set up on the ioloop thread, and only reading the
+        session hash from redis runs in the thread pool. If `load` is set, the
+        session hash is read if it hasn't been already.
+        """
+
+        session = self._session
+
+        if load and not session.loaded:
+            values = yield oz.redis.run_async(session.fetch)
+            session.load(values)
+
+        raise gen.Return(session)
+
+    @gen.coroutine
+    def get_session_value_async(self, name, default=None):
+        """Gets a session value without blocking the ioloop. Returns a future."""
+        yield self._session_async(load=True)
+        raise gen.Return(self.get_session_value(name, default=default))
+
+    @gen.coroutine
+    def set_session_value_async(self, name, value):
+        """Sets a session value without blocking the ioloop. Returns a future."""
+        yield self._session_async()
+        self.set_session_value(name, value)
+
+    @gen.coroutine
+    def clear_session_value_async(self, name):
+        """Removes a session value without blocking the ioloop. Returns a future."""
+        yield self._session_async()
+        self.clear_session_value(name)
 
-class RedisSessionMiddleware(object):
+class RedisSessionMiddleware(_SessionMiddleware):
     """Adds redis-backed session capabilities"""
 
+    def _set_session_cookie(self, session_id):
+        """Sets the session ID cookie, with an expiration based on `session_time`"""
+
+        session_time = oz.settings["session_time"]
+        kwargs = dict(
+            name="session_id",
+            value=session_id.encode('utf-8'),
+            domain=oz.settings.get("cookie_domain"),
+            httponly=True,
+        )
+        if session_time:
+            kwargs["expires_days"] = round(session_time/60/60/24)
+
+        self.set_secure_cookie(**kwargs)
+
     @property
     def _session_key(self):
-        """Gets the redis key for a session"""
+        """
+        Gets the redis key for a session. A new session ID, and its cookie,
+        are created if the request doesn't have one.
+        """
 
         if not hasattr(self, "_cached_session_key"):
             session_id_bytes = self.get_secure_cookie("session_id")
@@ -22,56 +170,130 @@ class RedisSessionMiddleware(object):
                 except:
                     pass
 
-            if not session_id:
+            if session_id:
+                self._session_cookie_set = False
+            else:
                 session_id = oz.redis_sessions.random_hex(20)
+                self._set_session_cookie(session_id)
+                self._session_cookie_set = True
 
-            session_time = oz.settings["session_time"]
-            kwargs = dict(
-                name="session_id",
-                value=session_id.encode('utf-8'),
-                domain=oz.settings.get("cookie_domain"),
-                httponly=True,
-            )
-            if session_time:
-                kwargs["expires_days"] = round(session_time/60/60/24)
+            self._session_id = session_id
+            self._cached_session_key = oz.redis_sessions.session_key(session_id)
 
-            self.set_secure_cookie(**kwargs)
+        return self._cached_session_key
 
-            password_salt = oz.settings["session_salt"]
-            self._cached_session_key = "session:%s:v4" % oz.redis_sessions.password_hash(session_id, password_salt=password_salt)
+    def _create_session(self):
+        """Creates the session object, without reading it from redis"""
+        return oz.redis_sessions.RedisSession(self.redis("sessions"), self._session_key)
 
-        return self._cached_session_key
+    def _refresh_session_cookie(self):
+        """Sends the session cookie again, unless it was just created"""
+
+        if not self._session_cookie_set:
+            self._set_session_cookie(self._session_id)
+            self._session_cookie_set = True
 
-    def _update_session_expiration(self):
+    def clear_all_session_values(self):
+        """Kills a session"""
+        self._session.clear()
+        self.clear_cookie("session_id")
+
+class CookieSessionMiddleware(_SessionMiddleware):
+    """
+    Adds sessions with the same API as `RedisSessionMiddleware`, but with the
+    values stored in a signed cookie. Sessions whose data grows beyond
+    `session_cookie_max_size` are moved to redis, which requires the redis
+    middleware.
+    """
+
+    def _create_session(self):
         """
-        Updates a redis item to expire later since it has been interacted with
-        recently
+        Creates the session object from the cookie. Sessions that have been
+        moved to redis are not read from it yet.
         """
 
         session_time = oz.settings["session_time"]
+        max_age_days = session_time / 60 / 60 / 24 if session_time else 31
+        payload = self.get_secure_cookie("session_data", max_age_days=max_age_days)
 
-        if session_time:
-            self.redis().expire(self._session_key, session_time)
+        if payload:
+            try:
+                if payload[:1] == oz.redis_sessions.COOKIE_SESSION_REDIS:
+                    self._session_id = payload[1:].decode("utf-8")
+                    return oz.redis_sessions.RedisSession(self.redis("sessions"), oz.redis_sessions.session_key(self._session_id))
+                else:
+                    return oz.redis_sessions.CookieSession(oz.redis_sessions.decode_cookie_session(payload))
+            except Exception:
+                tornado.log.app_log.warning("Could not decode the session cookie", exc_info=True)
 
-    def get_session_value(self, name, default=None):
-        """Gets a session value"""
+        return oz.redis_sessions.CookieSession()
 
-        value = self.redis().hget(self._session_key, name) or default
-        self._update_session_expiration()
-        return value
+    def _refresh_session_cookie(self):
+        """Sends the session cookie again"""
+        self._set_session_cookie()
 
-    def set_session_value(self, name, value):
-        """Sets a session value"""
+    def _set_session_cookie(self):
+        """
+        Sets the session cookie. Cookie sessions that have grown too large
+        are moved to redis, leaving only the session ID in the cookie.
+        """
 
-        self.redis().hset(self._session_key, name, value)
-        self._update_session_expiration()
+        session = self._cached_session
+        session_time = oz.settings["session_time"]
 
-    def clear_session_value(self, name):
-        """Removes a session value"""
-        self.redis().hdel(self._session_key, name)
-        self._update_session_expiration()
+        if isinstance(session, oz.redis_sessions.CookieSession):
+            if not session.data:
+                if self.get_cookie("session_data") != None:
+                    self.clear_cookie("session_data")
+
+                return
+
+            data = dict(session.data)
+
+            if session_time:
+                session.touched = time.time()
+                data[oz.redis_sessions.TOUCHED_FIELD] = oz.redis_sessions.encode_value(session.touched)
+
+            payload = oz.redis_sessions.encode_cookie_session(data, oz.settings["session_cookie_compress_threshold"])
+
+            if len(payload) > oz.settings["session_cookie_max_size"]:
+                self._session_id = oz.redis_sessions.random_hex(20)
+                redis_session = oz.redis_sessions.RedisSession(self.redis("sessions"), oz.redis_sessions.session_key(self._session_id))
+                redis_session.clear()
+
+                for name, value in session.data.items():
+                    redis_session.set(name, value)
+
+                self._cached_session = redis_session
+                payload = None
+        else:
+            payload = None
+
+        if payload == None:
+            payload = oz.redis_sessions.COOKIE_SESSION_REDIS + self._session_id.encode("utf-8")
+
+        kwargs = dict(
+            name="session_data",
+            value=payload,
+            domain=oz.settings.get("cookie_domain"),
+            httponly=True,
+        )
+        if session_time:
+            kwargs["expires_days"] = round(session_time/60/60/24)
+
+        self.set_secure_cookie(**kwargs)
+
+    def _session_changed(self):
+        """Sends the updated cookie for sessions stored in it"""
+
+        if isinstance(self._session, oz.redis_sessions.CookieSession):
+            self._set_session_cookie()
 
     def clear_all_session_values(self):
         """Kills a session"""
-        self.redis().delete(self._session_key)
-        self.clear_cookie("session_id")
+
+        if not isinstance(self._session, oz.redis_sessions.CookieSession):
+            self.redis("sessions").delete(self._session.key)
+
+        self._cached_session = oz.redis_sessions.CookieSession()
+        self._set_session_cookie()
@@ -7,5 +7,11 @@ import oz
 oz.options(
     session_salt = dict(type=str, help="Salt used for session security"),
     session_time = dict(type=int, help="Number of seconds of session inactivity before timeout"),
-    cookie_domain = dict(type=str, help="The domain of the session cookie")
+    cookie_domain = dict(type=str, help="The domain of the session cookie"),
+    session_refresh_fraction = dict(type=float, default=0, help="Fraction of session_time that must pass before a session's expiration is extended again; 0 extends it on every request"),
+    session_key_cache_size = dict(type=int, default=1024, help="Maximum number of session ID -> redis key mappings to cache in-process; 0 disables the cache"),
+    session_cookie_max_size = dict(type=int, default=2048, help="Maximum size in bytes of the session data stored by CookieSessionMiddleware in the cookie before it falls back to redis"),
+    session_cookie_compress_threshold = dict(type=int, default=256, help="Size in bytes above which CookieSessionMiddleware compresses session data; 0 disables compression"),
+    session_serializer = dict(type=str, default="raw", help="Format of session values: raw, json or msgpack"),
+    session_compress_threshold = dict(type=int, default=0, help="Size in bytes above which serialized session values are compressed; 0 disables compression")
 )
@@ -3,4 +3,5 @@ import tests.bandit
 import tests.blinks
 import tests.error_pages
 import tests.json_api
+import tests.redis
 import tests.redis_sessions
@@ -1,2 +1,3 @@
 """Tests for the aws_cdn plugin"""
+from .test_core import *
 from .test_middleware import *
@@ -0,0 +1,318 @@
+from __future__ import absolute_import, division, print_function, with_statement, unicode_literals
+
+import os
+import oz
+import oz.redis
+import io
+import shutil
+import collections
+import hashlib
+import tempfile
+import oz.aws_cdn
+import unittest
+
+@oz.test
+class CDNCoreTestCase(unittest.TestCase):
+    def setUp(self):
+        self.old_settings = oz.settings
+        self.static_path = tempfile.mkdtemp()
+        oz.settings = dict(oz.settings, s3_bucket=None, s3_prefix="", static_path=self.static_path, cdn_cache_buster_refresh_interval=60)
+        oz.aws_cdn.invalidate_cache_busters()
+
+    def tearDown(self):
+        oz.settings = self.old_settings
+        oz.aws_cdn.invalidate_cache_busters()
+
+        redis = oz.redis.create_connection()
+        redis.delete(oz.aws_cdn.CACHE_BUSTER_REDIS_KEY_TEMPLATE.format(None))
+        redis.delete(oz.aws_cdn.CACHE_BUSTER_VERSION_REDIS_KEY_TEMPLATE.format(None))
+        redis.delete(oz.aws_cdn.MANIFEST_REDIS_KEY_TEMPLATE.format(None))
+
+        shutil.rmtree(self.static_path)
+
+    def create_files(self, count):
+        contents = {}
+
+        for i in range(count):
+            path = "test-aws-cdn-core-%s" % i
+            contents[path] = os.urandom(oz.aws_cdn.CHUNK_SIZE + i + 1)
+            oz.aws_cdn.LocalFile(self.static_path, path).upload(contents[path])
+
+        return contents
+
+    def test_cached_cache_busters(self):
+        redis = oz.redis.create_connection()
+        oz.aws_cdn.set_cache_buster(redis, "test-cached-cache-buster", "abc")
+        self.assertEqual(oz.aws_cdn.get_cache_buster(redis, "test-cached-cache-buster"), "abc")
+
+        # Changes made by other processes aren't seen until the version is
+        # checked again
+        redis.hset(oz.aws_cdn.CACHE_BUSTER_REDIS_KEY_TEMPLATE.format(None), "test-cached-cache-buster", "def")
+        redis.incr(oz.aws_cdn.CACHE_BUSTER_VERSION_REDIS_KEY_TEMPLATE.format(None))
+        self.assertEqual(oz.aws_cdn.get_cache_buster(redis, "test-cached-cache-buster"), "abc")
+        self.assertEqual(oz.aws_cdn.load_cache_busters(redis, refresh_interval=0)["test-cached-cache-buster"], "def")
+
+        # Changes made by this process are seen immediately
+        oz.aws_cdn.remove_cache_buster(redis, "test-cached-cache-buster")
+        self.assertEqual(oz.aws_cdn.get_cache_buster(redis, "test-cached-cache-buster"), None)
+
+    def test_hash(self):
+        contents = self.create_files(1)["test-aws-cdn-core-0"]
+        f = oz.aws_cdn.LocalFile(self.static_path, "test-aws-cdn-core-0")
+        self.assertEqual(len(list(f.chunks())), 2)
+        self.assertEqual(f.hash(), hashlib.sha256(contents).hexdigest())
+
+    def test_hash_files(self):
+        contents = self.create_files(10)
+        expected = dict((path, hashlib.sha256(value).hexdigest()) for path, value in contents.items())
+
+        for workers in (1, 3):
+            files = oz.aws_cdn.list_files(["test-aws-cdn-core-"])
+            hashes = dict((f.path(), file_hash) for f, file_hash in oz.aws_cdn.hash_files(files, workers=workers))
+            self.assertEqual(hashes, expected)
+
+    def test_scan_cache_busters(self):
+        contents = self.create_files(3)
+        redis = oz.redis.create_connection()
+        version_key = oz.aws_cdn.CACHE_BUSTER_VERSION_REDIS_KEY_TEMPLATE.format(None)
+        scanned = dict(oz.aws_cdn.scan_cache_busters(redis, ["test-aws-cdn-core-"], batch_size=2))
+        self.assertEqual(scanned, dict((path, hashlib.sha256(value).hexdigest()) for path, value in contents.items()))
+
+        # The version is only bumped once per scan
+        self.assertEqual(redis.get(version_key), b"1")
+
+        for path, value in contents.items():
+            self.assertEqual(oz.aws_cdn.get_cache_buster(redis, path), hashlib.sha256(value).hexdigest())
+
+        # Only changed and removed files are picked up by the next scan
+        oz.aws_cdn.LocalFile(self.static_path, "test-aws-cdn-core-1").upload(b"changed", replace=True)
+        oz.aws_cdn.LocalFile(self.static_path, "test-aws-cdn-core-2").remove()
+        scanned = dict(oz.aws_cdn.scan_cache_busters(redis, ["test-aws-cdn-core-"], batch_size=2))
+        self.assertEqual(scanned, {
+            "test-aws-cdn-core-1": hashlib.sha256(b"changed").hexdigest(),
+            "test-aws-cdn-core-2": None,
+        })
+        self.assertEqual(oz.aws_cdn.get_cache_buster(redis, "test-aws-cdn-core-2"), None)
+        self.assertEqual(redis.get(version_key), b"2")
+
+        self.assertEqual(dict(oz.aws_cdn.scan_cache_busters(redis, ["test-aws-cdn-core-"])), {})
+        self.assertEqual(redis.get(version_key), b"2")
+        self.assertEqual(len(dict(oz.aws_cdn.scan_cache_busters(redis, ["test-aws-cdn-core-"], full=True))), 2)
+
+    def test_upload(self):
+        contents = os.urandom(oz.aws_cdn.CHUNK_SIZE * 2 + 1)
+        expected_hash = hashlib.sha256(contents).hexdigest()
+        f = oz.aws_cdn.LocalFile(self.static_path, "test-aws-cdn-core-upload")
+
+        self.assertEqual(list(oz.aws_cdn.iter_chunks(contents)), [contents[:oz.aws_cdn.CHUNK_SIZE], contents[oz.aws_cdn.CHUNK_SIZE:oz.aws_cdn.CHUNK_SIZE * 2], contents[-1:]])
+
+        # Bytes, file-like objects and iterables can all be uploaded
+        self.assertEqual(f.upload(contents), expected_hash)
+        self.assertEqual(f.upload(io.BytesIO(contents), replace=True), expected_hash)
+        self.assertEqual(f.upload(iter([contents[:10], contents[10:]]), replace=True), expected_hash)
+        self.assertEqual(f.contents(), contents)
+
+        # Nothing is uploaded if the file exists
+        self.assertEqual(f.upload(b"foo"), None)
+        self.assertEqual(f.contents(), contents)
+
+    def test_memoized_hash(self):
+        f = oz.aws_cdn.LocalFile(self.static_path, "test-aws-cdn-core-memo")
+        self.assertEqual(f.upload(b"foo"), hashlib.sha256(b"foo").hexdigest())
+
+        # The hash computed on upload is reused without reading the file
+        f.chunks = None
+        self.assertEqual(f.hash(), hashlib.sha256(b"foo").hexdigest())
+        del f.chunks
+
+        # ...until the file changes
+        with open(f.full_path, "wb") as fp:
+            fp.write(b"foobar")
+
+        self.assertEqual(f.hash(), hashlib.sha256(b"foobar").hexdigest())
+
+class FakeMultipartUpload(object):
+    """Stands in for a boto multipart upload"""
+
+    def __init__(self, key, fail_on_part=None):
+        self.key = key
+        self.fail_on_part = fail_on_part
+        self.parts = []
+        self.completed = False
+        self.cancelled = False
+
+    def upload_part_from_file(self, fp, part_num):
+        if part_num == self.fail_on_part:
+            raise IOError("Part upload failed")
+
+        self.parts.append((part_num, fp.read()))
+
+    def complete_upload(self):
+        self.completed = True
+        self.key.contents = b"".join(part for _, part in self.parts)
+        self.key.metadata = dict(self.key.uploaded_metadata)
+        return collections.namedtuple("CompletedUpload", "etag")('"multipart-%s"' % len(self.parts))
+
+    def cancel_upload(self):
+        self.cancelled = True
+
+class FakeS3Bucket(object):
+    """Stands in for a boto bucket"""
+
+    def __init__(self, fail_on_part=None):
+        self.fail_on_part = fail_on_part
+        self.keys = {}
+        self.multipart_uploads = []
+
+    def new_key(self, name, contents=None, metadata=None):
+        key = self.keys[name] = FakeS3Key(self, name, contents, metadata)
+        return key
+
+    def initiate_multipart_upload(self, name, headers=None):
+        multipart_upload = FakeMultipartUpload(self.keys[name], self.fail_on_part)
+        self.multipart_uploads.append(multipart_upload)
+        return multipart_upload
+
+class FakeS3Key(object):
+    """Stands in for a boto key, keeping its contents in memory"""
+
+    def __init__(self, bucket, name, contents=None, metadata=None):
+        self.bucket = bucket
+        self.name = name
+        self.contents = contents
+        self.metadata = metadata or {}
+        self.uploaded_metadata = {}
+        self.size = None if contents == None else len(contents)
+        self.etag = None if contents == None else '"%s"' % hashlib.md5(contents).hexdigest()
+        self.reads = 0
+        self.position = 0
+
+    def exists(self):
+        return self.contents != None
+
+    def set_metadata(self, name, value):
+        self.uploaded_metadata[name] = value
+
+    def get_metadata(self, name):
+        return self.metadata.get(name)
+
+    def set_contents_from_string(self, contents, headers=None):
+        self.contents = contents
+        self.metadata = dict(self.uploaded_metadata)
+        self.size = len(contents)
+        self.etag = '"%s"' % hashlib.md5(contents).hexdigest()
+
+    def read(self, size):
+        self.reads += 1
+        chunk = self.contents[self.position:self.position + size]
+        self.position += len(chunk)
+        return chunk
+
+    def close(self):
+        self.position = 0
+
+@oz.test
+class S3FileTestCase(unittest.TestCase):
+    def setUp(self):
+        self.old_settings = oz.settings
+        oz.settings = dict(oz.settings, cdn_multipart_threshold=oz.aws_cdn.CHUNK_SIZE)
+
+    def tearDown(self):
+        oz.settings = self.old_settings
+
+    def test_upload(self):
+        bucket = FakeS3Bucket()
+        f = oz.aws_cdn.S3File(bucket.new_key("test-s3-upload"))
+        self.assertEqual(f.upload(b"foo"), hashlib.sha256(b"foo").hexdigest())
+
+        # Small files are sent in one go, with their hash in the metadata
+        self.assertEqual(bucket.multipart_uploads, [])
+        self.assertEqual(f.key.contents, b"foo")
+        self.assertEqual(f.key.metadata, {"sha256": hashlib.sha256(b"foo").hexdigest()})
+
+        # Nothing is uploaded if the file exists
+        self.assertEqual(f.upload(b"bar"), None)
+        self.assertEqual(f.key.contents, b"foo")
+
+    def test_multipart_upload(self):
+        bucket = FakeS3Bucket()
+        f = oz.aws_cdn.S3File(bucket.new_key("test-s3-multipart-upload", b"foo", {"sha256": "stale"}))
+        contents = os.urandom(oz.aws_cdn.CHUNK_SIZE * 3 + 1)
+        self.assertEqual(f.upload(io.BytesIO(contents), replace=True), hashlib.sha256(contents).hexdigest())
+
+        # Files over the threshold are sent in parts, without a stored hash
+        self.assertEqual(len(bucket.multipart_uploads), 1)
+        multipart_upload = bucket.multipart_uploads[0]
+        self.assertTrue(multipart_upload.completed)
+        self.assertEqual([part_num for part_num, _ in multipart_upload.parts], [1, 2])
+        self.assertEqual(f.key.contents, contents)
+        self.assertEqual(f.key.metadata, {})
+        self.assertEqual(f.fingerprint(), (len(contents), '"multipart-2"'))
+
+    def test_failed_multipart_upload(self):
+        bucket = FakeS3Bucket(fail_on_part=2)
+        f = oz.aws_cdn.S3File(bucket.new_key("test-s3-failed-upload"))
+        self.assertRaises(IOError, f.upload, os.urandom(oz.aws_cdn.CHUNK_SIZE * 3 + 1))
+
+        multipart_upload = bucket.multipart_uploads[0]
+        self.assertTrue(multipart_upload.cancelled)
+        self.assertFalse(multipart_upload.completed)
+        self.assertFalse(f.exists())
+
+        # Failures in reading the contents cancel the upload too
+        def contents():
+            yield os.urandom(oz.aws_cdn.CHUNK_SIZE * 2)
+            raise ValueError("Read failed")
+
+        bucket = FakeS3Bucket()
+        f = oz.aws_cdn.S3File(bucket.new_key("test-s3-failed-upload"))
+        self.assertRaises(ValueError, f.upload, contents())
+        self.assertTrue(bucket.multipart_uploads[0].cancelled)
+
+    def test_stored_hash(self):
+        bucket = FakeS3Bucket()
+
+        # The hash stored on upload is used instead of downloading the file
+        f = oz.aws_cdn.S3File(bucket.new_key("test-s3-stored-hash", b"foo", {"sha256": hashlib.sha256(b"foo").hexdigest()}))
+        self.assertEqual(f.hash(), hashlib.sha256(b"foo").hexdigest())
+        self.assertEqual(f.key.reads, 0)
+
+    def test_memoized_hash(self):
+        bucket = FakeS3Bucket()
+        f = oz.aws_cdn.S3File(bucket.new_key("test-s3-memo", b"foo"))
+
+        # Files without a stored hash are downloaded once, and the hash is
+        # then reused while the fingerprint stays the same
+        self.assertEqual(f.hash(), hashlib.sha256(b"foo").hexdigest())
+        reads = f.key.reads
+        self.assertTrue(reads > 0)
+        self.assertEqual(f.hash(), hashlib.sha256(b"foo").hexdigest())
+        self.assertEqual(f.key.reads, reads)
+
+        # The hash computed on upload is memoized too
+        f.upload(b"bar", replace=True)
+        f.key.metadata = {}
+        self.assertEqual(f.hash(), hashlib.sha256(b"bar").hexdigest())
+        self.assertEqual(f.key.reads, reads)
+
+    def test_stale_hash(self):
+        bucket = FakeS3Bucket()
+        f = oz.aws_cdn.S3File(bucket.new_key("test-s3-stale", b"foo", {"sha256": hashlib.sha256(b"foo").hexdigest()}))
+        self.assertEqual(f.hash(), hashlib.sha256(b"foo").hexdigest())
+
+        # Once the fingerprint changes, the memoized hash is dropped: the file
+        # is downloaded if there is no stored hash...
+        f.key.set_contents_from_string(b"foobar")
+        self.assertEqual(f.key.metadata, {})
+        self.assertEqual(f.hash(), hashlib.sha256(b"foobar").hexdigest())
+        self.assertTrue(f.key.reads > 0)
+
+        # ...and a newly stored hash is picked up
+        f.key.metadata = {"sha256": "abc"}
+        f.key.etag = '"changed"'
+        self.assertEqual(f.hash(), "abc")
+
+        # A memoized hash is kept while the fingerprint stays the same, even
+        # if the metadata changes
+        f.key.metadata = {"sha256": "def"}
+        self.assertEqual(f.hash(), "abc")
@@ -1,8 +1,9 @@
 from __future__ import absolute_import, division, print_function, with_statement, unicode_literals
 
-import os
 import oz
 import oz.testing
+import shutil
+import tempfile
 import collections
 import oz.redis
 from oz.aws_cdn import CDNMiddleware
@@ -11,10 +12,13 @@ from tornado import escape, web
 @oz.test
 class CDNMiddlewareTestCase(oz.testing.OzTestCase):
     forced_settings = {
-        "static_host": "//fakecdn",
-        "static_path": "static"
+        "static_host": "//fakecdn"
     }
 
+    def setUp(self):
+        super(CDNMiddlewareTestCase, self).setUp()
+        self.static_path = oz.settings["static_path"] = tempfile.mkdtemp()
+
     def get_handlers(self):
         class CDNHandler(oz.RequestHandler, oz.redis.RedisMiddleware, CDNMiddleware):
             pass
@@ -66,9 +70,7 @@ class CDNMiddlewareTestCase(oz.testing.OzTestCase):
         redis.delete("cache-buster:v2")
 
         # Kill any test files
-        for f in os.listdir("static"):
-            if f.startswith("test-aws-cdn-"):
-                os.remove(os.path.join("static", f))
+        shutil.rmtree(self.static_path)
 
     def test_get_cache_buster(self):
         # Set a cache buster
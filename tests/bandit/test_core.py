@@ -1,13 +1,24 @@
 from __future__ import absolute_import, division, print_function, with_statement, unicode_literals
 
+import oz
 import oz.bandit
 import oz.redis
 import unittest
 
 class MockExperimentChoice(object):
-    def __init__(self, plays, rewards):
+    def __init__(self, plays, rewards, name=None, windowed_plays=None, windowed_rewards=None):
         self.plays = plays
         self.rewards = rewards
+        self.name = name
+        self.windowed_plays = plays if windowed_plays == None else windowed_plays
+        self.windowed_rewards = rewards if windowed_rewards == None else windowed_rewards
+        self.performance = float(self.windowed_rewards) / self.windowed_plays if self.windowed_plays > 0 else 0.0
+
+class MockExperiment(object):
+    def __init__(self, default_choice=None, **choices):
+        self.default_choice = default_choice
+        self.choices = [MockExperimentChoice(counts[0], counts[1], name, *counts[2:]) for name, counts in sorted(choices.items())]
+        self.choice_names = [choice.name for choice in self.choices]
 
 class BanditCoreTestCase(unittest.TestCase):
     def tearDown(self):
@@ -16,7 +27,7 @@ class BanditCoreTestCase(unittest.TestCase):
         # Clean up just in case there's keys still lying around
         redis = oz.redis.create_connection()
 
-        for key in redis.keys("bandit:*:v2"):
+        for key in redis.scan_iter("bandit:*:v2"):
             redis.delete(key)
 
 @oz.test
@@ -26,10 +37,30 @@ class IsConfidentTestCase(BanditCoreTestCase):
     """
 
     def test_is_confident(self):
-        self.assertFalse(oz.bandit.is_confident(3.83, 2))
-        self.assertTrue(oz.bandit.is_confident(3.84, 2))
-        self.assertFalse(oz.bandit.is_confident(5.98, 3))
-        self.assertTrue(oz.bandit.is_confident(5.99, 3))
+        self.assertFalse(oz.bandit.is_confident(3.84, 2))
+        self.assertTrue(oz.bandit.is_confident(3.85, 2))
+        self.assertFalse(oz.bandit.is_confident(5.99, 3))
+        self.assertTrue(oz.bandit.is_confident(6.00, 3))
+
+        # Large numbers of choices are supported
+        self.assertFalse(oz.bandit.is_confident(30.14, 20))
+        self.assertTrue(oz.bandit.is_confident(30.15, 20))
+
+        # Custom confidence levels are supported
+        self.assertFalse(oz.bandit.is_confident(3.85, 2, confidence=0.99))
+        self.assertTrue(oz.bandit.is_confident(6.64, 2, confidence=0.99))
+
+    def test_critical_value(self):
+        self.assertEqual(round(oz.bandit.chi_squared_critical_value(1, 0.05), 4), 3.8415)
+        self.assertEqual(round(oz.bandit.chi_squared_critical_value(10, 0.05), 3), 18.307)
+        self.assertEqual(round(oz.bandit.chi_squared_critical_value(100, 0.05), 3), 124.342)
+        self.assertEqual(round(oz.bandit.chi_squared_critical_value(2, 0.01), 3), 9.210)
+
+    def test_p_value(self):
+        self.assertEqual(oz.bandit.chi_squared_p_value(0, 3), 1.0)
+        self.assertEqual(round(oz.bandit.chi_squared_p_value(3.84, 1), 5), 0.05004)
+        self.assertEqual(round(oz.bandit.chi_squared_p_value(10, 4), 5), 0.04043)
+        self.assertEqual(round(oz.bandit.chi_squared_p_value(1, 4), 5), 0.90980)
 
 @oz.test
 class ChiSquaredTestCase(BanditCoreTestCase):
@@ -82,6 +113,72 @@ class SyncFromSpecTestCase(BanditCoreTestCase):
         # Check that ex-sync-4 has been setup
         self.assertEqual(oz.bandit.Experiment(redis, "ex-sync-4").choice_names, ["l", "m", "n"])
 
+        # De-archive ex-sync-1 while changing its choices
+        plan = oz.bandit.sync_from_spec(redis, {
+            "ex-sync-1": ["a", "z"],
+            "ex-sync-2": ["d", "e", "f"],
+            "ex-sync-3": ["g", "h", "j", "k"],
+            "ex-sync-4": ["l", "m", "n"],
+        })
+
+        self.assertEqual(plan.dearchived, ["ex-sync-1"])
+        self.assertEqual(plan.modified, {"ex-sync-1": (["z"], ["b", "c"], ["a", "z"])})
+        self.assertEqual(set(e.name for e in oz.bandit.get_experiments(redis, active=True)), set(["ex-sync-1", "ex-sync-2", "ex-sync-3", "ex-sync-4"]))
+        self.assertEqual(oz.bandit.Experiment(redis, "ex-sync-1").choice_names, ["a", "z"])
+
+    def test_sync_from_spec_dry_run(self):
+        redis = oz.redis.create_connection()
+        oz.bandit.sync_from_spec(redis, {"ex-dry-1": ["a", "b"]})
+
+        plan = oz.bandit.sync_from_spec(redis, {"ex-dry-1": ["a", "c"], "ex-dry-2": ["d"]}, dry_run=True)
+        self.assertEqual(plan.created, {"ex-dry-2": ["d"]})
+        self.assertEqual(plan.modified, {"ex-dry-1": (["c"], ["b"], ["a", "c"])})
+        self.assertEqual(plan.describe(), [
+            "- Creating experiment ex-dry-2",
+            "  - Adding choice d",
+            "- Adding choice c to existing experiment ex-dry-1",
+            "- Removing choice b from existing experiment ex-dry-1",
+        ])
+
+        # Nothing should have changed
+        self.assertEqual(oz.bandit.Experiment(redis, "ex-dry-1").choice_names, ["a", "b"])
+        self.assertRaises(oz.bandit.ExperimentException, oz.bandit.Experiment, redis, "ex-dry-2")
+
+        # Syncing the same spec twice is a no-op
+        self.assertFalse(oz.bandit.sync_from_spec(redis, {"ex-dry-1": ["a", "b"]}))
+
+    def test_sync_from_spec_validation(self):
+        redis = oz.redis.create_connection()
+
+        for spec in ({"bad name!": ["a"]}, {"ex-invalid": ["x y"]}, {"ex-invalid": ["A:B"]}, {"ex-invalid": ["a", "a"]}):
+            self.assertRaises(oz.bandit.ExperimentException, oz.bandit.sync_from_spec, redis, dict(spec, **{"ex-valid": ["a"]}))
+
+        # Nothing should have been written
+        self.assertEqual(oz.bandit.get_experiments(redis), [])
+
+    def test_sync_from_spec_concurrent_plays(self):
+        redis = oz.redis.create_connection()
+        oz.bandit.sync_from_spec(redis, {"ex-plays": ["a", "b"]})
+        experiment = oz.bandit.Experiment(redis, "ex-plays")
+
+        # Plays between planning and applying shouldn't force a retry
+        old_plan_from_spec = oz.bandit.plan_from_spec
+
+        def plan_from_spec(*args, **kwargs):
+            plan = old_plan_from_spec(*args, **kwargs)
+            experiment.add_play("a")
+            return plan
+
+        oz.bandit.plan_from_spec = plan_from_spec
+
+        try:
+            plan = oz.bandit.sync_from_spec(redis, {"ex-plays": ["a", "c"]})
+        finally:
+            oz.bandit.plan_from_spec = old_plan_from_spec
+
+        self.assertEqual(plan.modified, {"ex-plays": (["c"], ["b"], ["a", "c"])})
+        self.assertEqual(oz.bandit.Experiment(redis, "ex-plays").choice_names, ["a", "c"])
+
 @oz.test
 class AddExperimentTestCase(BanditCoreTestCase):
     def test_add_experiment(self):
@@ -170,6 +267,21 @@ class ExperimentTestCase(BanditCoreTestCase):
         csq, confident = experiment.confidence()
         self.assertEqual(round(csq, 3), 0.380)
         self.assertFalse(confident)
+        self.assertEqual(round(experiment.p_value(), 3), 0.537)
+
+    def test_confidence_many_choices(self):
+        redis = oz.redis.create_connection()
+        experiment = oz.bandit.add_experiment(redis, "ex-confidence-many")
+
+        for i in range(12):
+            experiment.add_choice("arm%s" % i)
+            experiment.add_play("arm%s" % i, count=100)
+
+        experiment.add_reward("arm0", count=90)
+
+        csq, confident = experiment.confidence()
+        self.assertTrue(confident)
+        self.assertTrue(experiment.p_value() < 0.05)
 
     def test_add_play(self):
         redis = oz.redis.create_connection()
@@ -190,3 +302,236 @@ class ExperimentTestCase(BanditCoreTestCase):
         self.assertEqual(experiment.choices[0].rewards, 0)
         experiment.add_reward("foo")
         self.assertEqual(experiment.choices[0].rewards, 1)
+
+    def test_choices_from_snapshot(self):
+        redis = oz.redis.create_connection()
+
+        experiment = oz.bandit.add_experiment(redis, "ex-snapshot")
+        experiment.add_choice("A")
+        experiment.add_choice("B")
+        experiment.add_play("A", count=4)
+        experiment.add_reward("A", count=1)
+        experiment.add_play("B", count=2)
+
+        # Choices should be built from the loaded snapshot, without going
+        # back to redis
+        experiment = oz.bandit.Experiment(redis, "ex-snapshot")
+        redis.delete(oz.bandit.EXPERIMENT_REDIS_KEY_TEMPLATE % "ex-snapshot")
+        self.assertEqual([(c.name, c.plays, c.rewards) for c in experiment.choices], [("A", 4, 1), ("B", 2, 0)])
+
+@oz.test
+class StrategyTestCase(BanditCoreTestCase):
+    def test_epsilon_greedy(self):
+        strategy = oz.bandit.EpsilonGreedyStrategy(epsilon=0)
+        self.assertEqual(strategy.choose(MockExperiment()), None)
+        self.assertEqual(strategy.choose(MockExperiment(default_choice="B", A=(0, 0), B=(0, 0))), "B")
+
+        # Falls back to a random choice if there is no valid default
+        self.assertEqual(strategy.choose(MockExperiment(default_choice="C", A=(0, 0))), "A")
+
+    def test_thompson_sampling(self):
+        strategy = oz.bandit.ThompsonSamplingStrategy()
+        self.assertEqual(strategy.choose(MockExperiment()), None)
+
+        experiment = MockExperiment(A=(1000, 100), B=(1000, 900))
+
+        for _ in range(10):
+            self.assertEqual(strategy.choose(experiment), "B")
+
+    def test_ucb1(self):
+        strategy = oz.bandit.UCB1Strategy()
+        self.assertEqual(strategy.choose(MockExperiment()), None)
+
+        # Unplayed choices are tried first
+        self.assertEqual(strategy.choose(MockExperiment(A=(10, 5), B=(0, 0))), "B")
+
+        self.assertEqual(strategy.choose(MockExperiment(A=(1000, 100), B=(1000, 900))), "B")
+
+        # Rarely played choices get explored
+        self.assertEqual(strategy.choose(MockExperiment(A=(10000, 5000), B=(1, 0))), "B")
+
+        # Choices that are as good as each other are spread across users,
+        # even when the counters don't change between choices
+        experiment = MockExperiment(A=(100, 50), B=(100, 50))
+        self.assertEqual(set(strategy.choose(experiment) for _ in range(50)), set(["A", "B"]))
+
+    def test_strategies_use_windowed_counts(self):
+        # A did better over its lifetime, but B does better within the window
+        experiment = MockExperiment(A=(1000, 900, 100, 10), B=(1000, 100, 100, 90))
+
+        for strategy in (oz.bandit.ThompsonSamplingStrategy(), oz.bandit.UCB1Strategy()):
+            for _ in range(10):
+                self.assertEqual(strategy.choose(experiment), "B")
+
+        # Choices without plays in the window are tried first
+        self.assertEqual(oz.bandit.UCB1Strategy().choose(MockExperiment(A=(1000, 900, 0.5, 0.25), B=(1000, 100, 0, 0))), "B")
+        self.assertEqual(oz.bandit.UCB1Strategy().choose(MockExperiment(A=(1000, 900, 0.5, 0.25), B=(1000, 100, 0.25, 0.25))), "B")
+
+    def test_experiment_strategy(self):
+        redis = oz.redis.create_connection()
+
+        self.assertRaises(oz.bandit.ExperimentException, oz.bandit.add_experiment, redis, "ex-strategy-illegal", strategy="fake")
+
+        experiment = oz.bandit.add_experiment(redis, "ex-strategy", strategy="ucb1")
+        self.assertTrue(isinstance(experiment.strategy, oz.bandit.UCB1Strategy))
+
+        experiment.set_strategy("thompson-sampling")
+        experiment = oz.bandit.Experiment(redis, "ex-strategy")
+        self.assertTrue(isinstance(experiment.strategy, oz.bandit.ThompsonSamplingStrategy))
+
+        self.assertRaises(oz.bandit.ExperimentException, experiment.set_strategy, "fake")
+
+        experiment = oz.bandit.add_experiment(redis, "ex-strategy-default")
+        self.assertTrue(isinstance(experiment.strategy, oz.bandit.EpsilonGreedyStrategy))
+
+@oz.test
+class ExperimentCacheTestCase(BanditCoreTestCase):
+    def setUp(self):
+        super(ExperimentCacheTestCase, self).setUp()
+        self.old_settings = oz.settings
+        oz.settings = dict(oz.settings, bandit_cache_ttl=60)
+
+    def tearDown(self):
+        super(ExperimentCacheTestCase, self).tearDown()
+        oz.settings = self.old_settings
+        oz.bandit._experiment_cache.clear()
+
+    def test_cached_experiment(self):
+        redis = oz.redis.create_connection()
+
+        experiment = oz.bandit.add_experiment(redis, "ex-cache")
+        experiment.add_choice("A")
+        self.assertEqual(oz.bandit.get_cached_experiment(redis, "ex-cache").choice_names, ["A"])
+
+        # Changes made from elsewhere should not be picked up until the cache
+        # expires
+        redis.hset(oz.bandit.EXPERIMENT_REDIS_KEY_TEMPLATE % "ex-cache", "choices", '["A", "B"]')
+        self.assertEqual(oz.bandit.get_cached_experiment(redis, "ex-cache").choice_names, ["A"])
+
+        # Changes made in this process should invalidate the cache
+        experiment.add_choice("C")
+        self.assertEqual(oz.bandit.get_cached_experiment(redis, "ex-cache").choice_names, ["A", "C"])
+
+    def test_missing_experiment(self):
+        redis = oz.redis.create_connection()
+        self.assertRaises(oz.bandit.ExperimentException, oz.bandit.get_cached_experiment, redis, "ex-cache-missing")
+        self.assertFalse("ex-cache-missing" in oz.bandit._experiment_cache)
+
+@oz.test
+class BufferedCountersTestCase(BanditCoreTestCase):
+    def setUp(self):
+        super(BufferedCountersTestCase, self).setUp()
+        self.old_settings = oz.settings
+        oz.settings = dict(oz.settings, bandit_flush_interval=60)
+
+    def tearDown(self):
+        super(BufferedCountersTestCase, self).tearDown()
+        oz.settings = self.old_settings
+        oz.bandit._pending_counts.clear()
+
+    def test_flush_counters(self):
+        redis = oz.redis.create_connection()
+        experiment = oz.bandit.add_experiment(redis, "ex-buffered")
+        experiment.add_choice("A")
+
+        experiment.add_play("A", buffered=True)
+        experiment.add_play("A", count=2, buffered=True)
+        experiment.add_reward("A", buffered=True)
+
+        # The local snapshot is updated, but redis is not
+        self.assertEqual(experiment.choices[0].plays, 3)
+        self.assertEqual(oz.bandit.Experiment(redis, "ex-buffered").choices[0].plays, 0)
+
+        oz.bandit.flush_counters(redis)
+        choice = oz.bandit.Experiment(redis, "ex-buffered").choices[0]
+        self.assertEqual((choice.plays, choice.rewards), (3, 1))
+
+        # Flushing again should be a no-op
+        oz.bandit.flush_counters(redis)
+        self.assertEqual(oz.bandit.Experiment(redis, "ex-buffered").choices[0].plays, 3)
+
+@oz.test
+class LoadExperimentsTestCase(BanditCoreTestCase):
+    def test_load_experiments(self):
+        redis = oz.redis.create_connection()
+
+        for name in ["ex-load-1", "ex-load-2"]:
+            experiment = oz.bandit.add_experiment(redis, name)
+            experiment.add_choice("A")
+            experiment.add_play("A", count=2)
+
+        experiments = oz.bandit.load_experiments(redis, ["ex-load-2", "ex-load-1"])
+        self.assertEqual([e.name for e in experiments], ["ex-load-2", "ex-load-1"])
+        self.assertEqual([e.choices[0].plays for e in experiments], [2, 2])
+
+        self.assertEqual(oz.bandit.load_experiments(redis, []), [])
+        self.assertRaises(oz.bandit.ExperimentException, oz.bandit.load_experiments, redis, ["ex-load-missing"])
+
+@oz.test
+class RecomputeDefaultChoicesTestCase(BanditCoreTestCase):
+    def test_recompute_default_choices(self):
+        redis = oz.redis.create_connection()
+
+        for name in ["ex-recompute-1", "ex-recompute-2"]:
+            experiment = oz.bandit.add_experiment(redis, name)
+            experiment.add_choice("A")
+            experiment.add_choice("B")
+
+        # Both experiments had choices added
+        experiments = oz.bandit.recompute_default_choices(redis)
+        self.assertEqual(set(e.name for e in experiments), set(["ex-recompute-1", "ex-recompute-2"]))
+        self.assertEqual(oz.bandit.Experiment(redis, "ex-recompute-1").default_choice, "A")
+
+        # Nothing changed since the last pass
+        self.assertEqual(oz.bandit.recompute_default_choices(redis), [])
+
+        experiment = oz.bandit.Experiment(redis, "ex-recompute-1")
+        experiment.add_play("B")
+        experiment.add_reward("B")
+        experiments = oz.bandit.recompute_default_choices(redis)
+        self.assertEqual([e.name for e in experiments], ["ex-recompute-1"])
+        self.assertEqual(oz.bandit.Experiment(redis, "ex-recompute-1").default_choice, "B")
+
+        # Deleted experiments are skipped
+        redis.sadd(oz.bandit.DIRTY_EXPERIMENTS_REDIS_KEY, "ex-recompute-missing")
+        self.assertEqual(oz.bandit.recompute_default_choices(redis), [])
+
+@oz.test
+class BucketedCountersTestCase(BanditCoreTestCase):
+    def setUp(self):
+        super(BucketedCountersTestCase, self).setUp()
+        self.old_settings = oz.settings
+
+        # Use huge buckets so that the test never straddles two of them
+        oz.settings = dict(oz.settings, bandit_bucket_seconds=10 ** 9, bandit_bucket_retention=2, bandit_bucket_half_life=1)
+
+    def tearDown(self):
+        super(BucketedCountersTestCase, self).tearDown()
+        oz.settings = self.old_settings
+
+    def test_bucketed_performance(self):
+        redis = oz.redis.create_connection()
+        key = oz.bandit.EXPERIMENT_REDIS_KEY_TEMPLATE % "ex-buckets"
+        bucket = oz.bandit.current_bucket()
+
+        experiment = oz.bandit.add_experiment(redis, "ex-buckets")
+        experiment.add_choice("A")
+        experiment.add_play("A", count=10)
+        experiment.add_reward("A", count=5)
+        self.assertEqual(redis.hget(key, "A:plays:%s" % bucket), b"10")
+        self.assertEqual(redis.hget(key, "A:rewards:%s" % bucket), b"5")
+
+        # The previous bucket is weighed half as much; buckets past the
+        # retention period are ignored
+        redis.hset(key, "A:plays:%s" % (bucket - 1), 10)
+        redis.hset(key, "A:plays:%s" % (bucket - 5), 100)
+        redis.hset(key, "A:rewards:%s" % (bucket - 5), 100)
+
+        choice = oz.bandit.Experiment(redis, "ex-buckets").choices[0]
+        self.assertEqual((choice.plays, choice.rewards), (10, 5))
+        self.assertEqual((choice.windowed_plays, choice.windowed_rewards), (15, 5))
+        self.assertEqual(round(choice.performance, 3), 0.333)
+
+        oz.bandit.recompute_default_choices(redis)
+        self.assertFalse(redis.hexists(key, "A:plays:%s" % (bucket - 5)))
+        self.assertTrue(redis.hexists(key, "A:plays:%s" % (bucket - 1)))
@@ -3,9 +3,9 @@ from __future__ import absolute_import, division, print_function, with_statement
 import oz
 import oz.testing
 import oz.bandit
-from oz.redis_sessions import RedisSessionMiddleware
+from oz.redis_sessions import RedisSessionMiddleware, CookieSessionMiddleware
 from oz.redis import RedisMiddleware
-from tornado import web
+from tornado import web, gen
 
 @oz.test
 class BanditMiddlewareTestCase(oz.testing.OzTestCase):
@@ -41,8 +41,33 @@ class BanditMiddlewareTestCase(oz.testing.OzTestCase):
                 # Removes the currently set choice for an experiment
                 self.leave_experiment(name)
 
+        class ChooseHandler(oz.testing.FakeCookiesHandler, RedisMiddleware, RedisSessionMiddleware, oz.bandit.BanditTestingMiddleware):
+            def get(self, name):
+                # Sets a choice for an existing experiment
+                self.finish(self.choose_experiment(name) or "")
+
+        class AsyncChooseHandler(ChooseHandler):
+            @gen.coroutine
+            def get(self, name):
+                choice = yield self.choose_experiment_async(name)
+                self.finish(choice or "")
+
+        class ChoosePlaysHandler(ChooseHandler):
+            def get(self, name):
+                # Reports the plays recorded in redis once a choice is made
+                self.choose_experiment(name)
+                experiment = oz.bandit.Experiment(oz.redis.create_connection(), name)
+                self.finish(str(sum(c.plays for c in experiment.choices)))
+
+        class BatchedChoosePlaysHandler(ChoosePlaysHandler):
+            batch_redis_writes = True
+
         return [
             (r"/experiment/(.+)", ExperimentHandler),
+            (r"/choose/(.+)", ChooseHandler),
+            (r"/choose-async/(.+)", AsyncChooseHandler),
+            (r"/choose-plays/(.+)", ChoosePlaysHandler),
+            (r"/choose-plays-batched/(.+)", BatchedChoosePlaysHandler),
         ]
 
     def tearDown(self):
@@ -51,7 +76,7 @@ class BanditMiddlewareTestCase(oz.testing.OzTestCase):
         # Clean up just in case there's keys still lying around
         redis = oz.redis.create_connection()
 
-        for key in redis.keys("bandit:*:v2"):
+        for key in redis.scan_iter("bandit:*:v2"):
             redis.delete(key)
 
     def test_get_experiment_choice(self):
@@ -80,6 +105,32 @@ class BanditMiddlewareTestCase(oz.testing.OzTestCase):
         response = self.request("/experiment/choose-experiment-example?cookie_id=bandit")
         self.assertTrue(response.body in [b"A", b"B", b"C"])
 
+    def test_choose_experiment_async(self):
+        redis = oz.redis.create_connection()
+        experiment = oz.bandit.add_experiment(redis, "choose-async-example")
+        experiment.add_choice("A")
+
+        response = self.request("/choose-async/choose-async-example?cookie_id=bandit-async")
+        self.assertEqual(response.body, b"A")
+
+        response = self.request("/experiment/choose-async-example?cookie_id=bandit-async")
+        self.assertEqual(response.body, b"A")
+
+    def test_choose_experiment_writes_plays(self):
+        redis = oz.redis.create_connection()
+        experiment = oz.bandit.add_experiment(redis, "choose-plays-example")
+        experiment.add_choice("A")
+
+        # Plays are written immediately unless the handler opts into batching
+        response = self.request("/choose-plays/choose-plays-example?cookie_id=bandit-plays")
+        self.assertEqual(response.body, b"1")
+
+        response = self.request("/choose-plays-batched/choose-plays-example?cookie_id=bandit-plays-batched")
+        self.assertEqual(response.body, b"1")
+
+        experiment = oz.bandit.Experiment(redis, "choose-plays-example")
+        self.assertEqual(sum(c.plays for c in experiment.choices), 2)
+
     def test_join_experiment(self):
         # Create an experiment
         response = self.request("/experiment/join-experiment-example?cookie_id=bandit", method="POST", body="")
@@ -91,3 +142,103 @@ class BanditMiddlewareTestCase(oz.testing.OzTestCase):
         # Make sure we joined the right one
         response = self.request("/experiment/join-experiment-example?cookie_id=bandit")
         self.assertEqual(response.body, b"B")
+
+@oz.test
+class AtomicBanditMiddlewareTestCase(BanditMiddlewareTestCase):
+    forced_settings = {
+        "session_salt": "abc",
+        "session_time": 60,
+        "bandit_atomic_choices": True
+    }
+
+    def test_choose_experiment_atomically(self):
+        response = self.request("/experiment/atomic-experiment-example?cookie_id=bandit-atomic", method="POST", body="")
+        self.assertEqual(response.code, 200)
+
+        response = self.request("/experiment/atomic-experiment-example?cookie_id=bandit-atomic")
+        choice = response.body
+        self.assertTrue(choice in [b"A", b"B", b"C"])
+
+        # The choice should stick across requests, with a play counted each
+        # time
+        response = self.request("/choose/atomic-experiment-example?cookie_id=bandit-atomic")
+        self.assertEqual(response.body, choice)
+
+        redis = oz.redis.create_connection()
+        experiment = oz.bandit.Experiment(redis, "atomic-experiment-example")
+        self.assertEqual(dict((c.name, c.plays) for c in experiment.choices if c.plays), {choice.decode("utf-8"): 2})
+
+    def test_choose_experiment_writes_plays(self):
+        redis = oz.redis.create_connection()
+        experiment = oz.bandit.add_experiment(redis, "atomic-plays-example")
+        experiment.add_choice("A")
+
+        # Atomic choices count the play in the same script call, so it's
+        # written immediately even with batching
+        response = self.request("/choose-plays/atomic-plays-example?cookie_id=bandit-atomic-plays")
+        self.assertEqual(response.body, b"1")
+
+        response = self.request("/choose-plays-batched/atomic-plays-example?cookie_id=bandit-atomic-plays-batched")
+        self.assertEqual(response.body, b"2")
+
+    def get_handlers(self):
+        class SessionLoadHandler(oz.testing.FakeCookiesHandler, RedisMiddleware, RedisSessionMiddleware, oz.bandit.BanditTestingMiddleware):
+            def get(self, name):
+                # Reports whether choosing needed the whole session loaded,
+                # or left anything to write back when the request finishes
+                choice = self.choose_experiment(name)
+                assert self.get_experiment_choice(name) == choice
+
+                self.finish("%s:%s:%s" % (
+                    choice,
+                    "loaded" if self._session._data != None else "unloaded",
+                    "dirty" if self._session._updates or self._session.accessed else "clean"
+                ))
+
+        class CookieChooseHandler(oz.testing.FakeCookiesHandler, RedisMiddleware, CookieSessionMiddleware, oz.bandit.BanditTestingMiddleware):
+            def get(self, name):
+                self.finish(self.choose_experiment(name) or "")
+
+        return super(AtomicBanditMiddlewareTestCase, self).get_handlers() + [
+            (r"/choose-session-load/(.+)", SessionLoadHandler),
+            (r"/choose-cookie/(.+)", CookieChooseHandler),
+        ]
+
+    def test_choose_experiment_atomically_keeps_joined_choice(self):
+        response = self.request("/experiment/atomic-joined-example?cookie_id=bandit-atomic-joined", method="POST", body="")
+        self.assertEqual(response.code, 200)
+
+        response = self.request("/experiment/atomic-joined-example?cookie_id=bandit-atomic-joined&choice=B", method="PUT", body="")
+        self.assertEqual(response.code, 200)
+
+        for _ in range(3):
+            response = self.request("/choose-session-load/atomic-joined-example?cookie_id=bandit-atomic-joined")
+            self.assertEqual(response.body, b"B:unloaded:clean")
+
+        response = self.request("/experiment/atomic-joined-example?cookie_id=bandit-atomic-joined")
+        self.assertEqual(response.body, b"B")
+
+    def test_choose_missing_choice_atomically(self):
+        redis = oz.redis.create_connection()
+        oz.bandit.add_experiment(redis, "atomic-empty-example")
+
+        response = self.request("/choose/atomic-empty-example?cookie_id=bandit-atomic")
+        self.assertEqual(response.body, b"")
+
+    def test_choose_experiment_atomically_with_cookie_sessions(self):
+        redis = oz.redis.create_connection()
+        experiment = oz.bandit.add_experiment(redis, "atomic-cookie-example")
+        experiment.add_choice("A")
+
+        # Cookie sessions have no redis hash for the script to update
+        response = self.request("/choose-cookie/atomic-cookie-example?cookie_id=bandit-atomic-cookie")
+        self.assertEqual(response.code, 500)
+
+@oz.test
+class SerializedAtomicBanditMiddlewareTestCase(AtomicBanditMiddlewareTestCase):
+    forced_settings = {
+        "session_salt": "abc",
+        "session_time": 60,
+        "session_serializer": "json",
+        "bandit_atomic_choices": True
+    }
@@ -0,0 +1,2 @@
+from .test_core import *
+from .test_middleware import *
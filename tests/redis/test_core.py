@@ -0,0 +1,92 @@
+from __future__ import absolute_import, division, print_function, with_statement, unicode_literals
+
+import oz
+import oz.redis
+import unittest
+
+@oz.test
+class CreateConnectionTestCase(unittest.TestCase):
+    def setUp(self):
+        super(CreateConnectionTestCase, self).setUp()
+        self.old_settings = oz.settings
+        oz.settings = dict(oz.settings, redis_max_connections=5, redis_connections={
+            "secondary": {"db": 1, "max_connections": 3},
+        })
+
+        self.old_pools = dict(oz.redis._pools)
+        self.old_cached_connections = dict(oz.redis._cached_connections)
+        oz.redis._pools.clear()
+        oz.redis._cached_connections.clear()
+
+    def tearDown(self):
+        super(CreateConnectionTestCase, self).tearDown()
+        oz.settings = self.old_settings
+        oz.redis._pools.clear()
+        oz.redis._pools.update(self.old_pools)
+        oz.redis._cached_connections.clear()
+        oz.redis._cached_connections.update(self.old_cached_connections)
+
+    def test_default_connection(self):
+        conn = oz.redis.create_connection()
+        self.assertTrue(conn is oz.redis.create_connection())
+        self.assertEqual(conn.connection_pool.max_connections, 5)
+        self.assertEqual(conn.connection_pool.connection_kwargs["db"], 0)
+
+        # Unconfigured names share the default connection
+        self.assertTrue(oz.redis.create_connection("sessions") is conn)
+
+    def test_named_connection(self):
+        conn = oz.redis.create_connection("secondary")
+        self.assertTrue(conn is oz.redis.create_connection("secondary"))
+        self.assertTrue(conn is not oz.redis.create_connection())
+        self.assertEqual(conn.connection_pool.max_connections, 3)
+        self.assertEqual(conn.connection_pool.connection_kwargs["db"], 1)
+        self.assertEqual(conn.connection_pool.connection_kwargs["host"], oz.settings["redis_host"])
+
+    def test_uncached_connection(self):
+        oz.settings["redis_cache_connections"] = False
+        self.assertTrue(oz.redis.create_connection() is not oz.redis.create_connection())
+
+    def test_fork(self):
+        conn = oz.redis.create_connection()
+        conn.ping()
+        pool = conn.connection_pool
+
+        # Simulate being in a forked child process
+        old_pid = oz.redis._pid
+        oz.redis._pid = -1
+
+        try:
+            child_conn = oz.redis.create_connection()
+            self.assertTrue(child_conn is not conn)
+            self.assertTrue(child_conn.connection_pool is not pool)
+            self.assertTrue(pool in oz.redis._inherited_pools)
+            self.assertTrue(child_conn.ping())
+        finally:
+            oz.redis._pid = old_pid
+            oz.redis._inherited_pools.remove(pool)
+
+@oz.test
+class RequestBatchTestCase(unittest.TestCase):
+    def tearDown(self):
+        super(RequestBatchTestCase, self).tearDown()
+        oz.redis.create_connection().delete("test-request-batch-1", "test-request-batch-2")
+
+    def test_prefetch(self):
+        redis = oz.redis.create_connection()
+        redis.set("test-request-batch-1", "foo")
+        redis.set("test-request-batch-2", "bar")
+
+        batch = oz.redis.RequestBatch(redis)
+        batch.prefetch("get", "test-request-batch-1")
+        pipelines = []
+        pipeline = redis.pipeline
+        redis.pipeline = lambda *args, **kwargs: pipelines.append(args) or pipeline(*args, **kwargs)
+
+        try:
+            # Unregistered reads are fetched along with the pending ones
+            self.assertEqual(batch.get_prefetched("get", "test-request-batch-2"), b"bar")
+            self.assertEqual(batch.get_prefetched("get", "test-request-batch-1"), b"foo")
+            self.assertEqual(len(pipelines), 1)
+        finally:
+            del redis.pipeline
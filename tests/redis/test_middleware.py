@@ -0,0 +1,64 @@
+from __future__ import absolute_import, division, print_function, with_statement, unicode_literals
+
+import oz
+import oz.testing
+import oz.redis
+from oz.redis import RedisMiddleware
+from tornado import gen
+
+@oz.test
+class RedisMiddlewareTestCase(oz.testing.OzTestCase):
+    def get_handlers(self):
+        class AsyncRedisHandler(oz.RequestHandler, RedisMiddleware):
+            @gen.coroutine
+            def get(self, key):
+                value = yield self.redis_async().get(key)
+                self.finish(value or b"")
+
+            @gen.coroutine
+            def put(self, key):
+                pipe = self.redis_async().pipeline()
+                pipe.set(key, self.request.body)
+                pipe.expire(key, 60)
+                yield pipe.execute()
+
+        class BatchedRedisHandler(oz.RequestHandler, RedisMiddleware):
+            def initialize(self):
+                super(BatchedRedisHandler, self).initialize()
+                self.redis_batch().prefetch("get", "test-redis-batch")
+
+            def get(self):
+                count = self.redis_batch().get_prefetched("get", "test-redis-batch")
+                assert self.redis_batch().incr("test-redis-batch") is None
+                self.redis_batch().expire("test-redis-batch", 60)
+                self.finish(count or b"0")
+
+        return [
+            (r"/async/(.+)", AsyncRedisHandler),
+            (r"/batch", BatchedRedisHandler),
+        ]
+
+    def tearDown(self):
+        super(RedisMiddlewareTestCase, self).tearDown()
+        oz.redis.create_connection().delete("test-redis-async", "test-redis-batch")
+
+    def test_redis_async(self):
+        response = self.request("/async/test-redis-async")
+        self.assertEqual(response.body, b"")
+
+        response = self.request("/async/test-redis-async", method="PUT", body="foo")
+        self.assertEqual(response.code, 200)
+
+        response = self.request("/async/test-redis-async")
+        self.assertEqual(response.body, b"foo")
+
+    def test_redis_batch(self):
+        response = self.request("/batch")
+        self.assertEqual(response.body, b"0")
+
+        response = self.request("/batch")
+        self.assertEqual(response.body, b"1")
+
+        redis = oz.redis.create_connection()
+        self.assertEqual(redis.get("test-redis-batch"), b"2")
+        self.assertTrue(redis.ttl("test-redis-batch") > 0)
@@ -1,8 +1,10 @@
 from __future__ import absolute_import, division, print_function, with_statement, unicode_literals
 
 import oz.redis_sessions
+import oz.redis
 import oz
 import unittest
+import time
 
 @oz.test
 class CDNCoreTestCase(unittest.TestCase):
@@ -10,6 +12,25 @@ class CDNCoreTestCase(unittest.TestCase):
         hash = oz.redis_sessions.password_hash("bar", password_salt="foo")
         self.assertEqual(hash, "sha256!c3ab8ff13720e8ad9047dd39466b3c8974e592c2fa383d4a3960714caef0c4f2")
 
+    def test_session_key(self):
+        old_settings = oz.settings
+        oz.settings = dict(oz.settings, session_salt="foo", session_key_cache_size=2)
+
+        try:
+            oz.redis_sessions._session_keys.clear()
+            key = oz.redis_sessions.session_key("bar")
+            self.assertEqual(key, "session:%s:v4" % oz.redis_sessions.password_hash("bar", password_salt="foo"))
+            self.assertEqual(oz.redis_sessions.session_key("bar"), key)
+
+            # The least recently used keys are evicted
+            oz.redis_sessions.session_key("baz")
+            oz.redis_sessions.session_key("bar")
+            oz.redis_sessions.session_key("qux")
+            self.assertEqual(list(oz.redis_sessions._session_keys.keys()), [("foo", "bar"), ("foo", "qux")])
+        finally:
+            oz.settings = old_settings
+            oz.redis_sessions._session_keys.clear()
+
     def test_random_hex(self):
         hexchars = set("0123456789abcdef")
 
@@ -26,3 +47,187 @@ class CDNCoreTestCase(unittest.TestCase):
             self.assertTrue(c in hexchars, "%s not in %s" % (c, hexchars))
 
         self.assertNotEqual(s1, s2)
+
+    def test_session(self):
+        redis = oz.redis.create_connection()
+        redis.delete("test-redis-session")
+        redis.hset("test-redis-session", "a", "1")
+        redis.hset("test-redis-session", "b", "2")
+
+        try:
+            session = oz.redis_sessions.RedisSession(redis, "test-redis-session")
+            self.assertEqual(session.get("a"), b"1")
+            self.assertFalse(session.modified)
+
+            session.set("c", 3)
+            session.delete("b")
+            self.assertEqual(session.get("c"), b"3")
+            self.assertEqual(session.get("b"), None)
+            self.assertTrue(session.modified)
+
+            # Nothing is written until the session is saved
+            self.assertEqual(redis.hgetall("test-redis-session"), {b"a": b"1", b"b": b"2"})
+
+            pipe = redis.pipeline(transaction=False)
+            session.save(pipe, 60)
+            pipe.execute()
+            self.assertFalse(session.modified)
+            self.assertEqual(redis.hgetall("test-redis-session"), {b"a": b"1", b"c": b"3"})
+            self.assertTrue(redis.ttl("test-redis-session") > 0)
+
+            session.clear()
+            session.set("d", "4")
+            pipe = redis.pipeline(transaction=False)
+            session.save(pipe, 60)
+            pipe.execute()
+            self.assertEqual(redis.hgetall("test-redis-session"), {b"d": b"4"})
+        finally:
+            redis.delete("test-redis-session")
+
+    def test_session_refresh_fraction(self):
+        redis = oz.redis.create_connection()
+        redis.delete("test-redis-session-refresh")
+
+        try:
+            # New sessions always get an expiration
+            session = oz.redis_sessions.RedisSession(redis, "test-redis-session-refresh")
+            session.set("a", "1")
+            self.assertTrue(session.needs_refresh(60, 0.5))
+            pipe = redis.pipeline(transaction=False)
+            session.save(pipe, 60, 0.5)
+            pipe.execute()
+            self.assertTrue(redis.ttl("test-redis-session-refresh") > 0)
+            self.assertTrue(redis.hexists("test-redis-session-refresh", oz.redis_sessions.TOUCHED_FIELD))
+
+            # Recently touched sessions are left alone
+            redis.persist("test-redis-session-refresh")
+            session = oz.redis_sessions.RedisSession(redis, "test-redis-session-refresh")
+            self.assertEqual(session.get("a"), b"1")
+            self.assertFalse(session.needs_refresh(60, 0.5))
+
+            # The touched time is kept out of the session values
+            self.assertEqual(session.get(oz.redis_sessions.TOUCHED_FIELD), None)
+            self.assertEqual(list(session.data.keys()), ["a"])
+            pipe = redis.pipeline(transaction=False)
+            session.save(pipe, 60, 0.5)
+            pipe.execute()
+            self.assertEqual(redis.ttl("test-redis-session-refresh"), -1)
+
+            # ...until enough of the session time has passed
+            redis.hset("test-redis-session-refresh", oz.redis_sessions.TOUCHED_FIELD, time.time() - 31)
+            session = oz.redis_sessions.RedisSession(redis, "test-redis-session-refresh")
+            self.assertEqual(session.get("a"), b"1")
+            self.assertTrue(session.needs_refresh(60, 0.5))
+            pipe = redis.pipeline(transaction=False)
+            session.save(pipe, 60, 0.5)
+            pipe.execute()
+            self.assertTrue(redis.ttl("test-redis-session-refresh") > 0)
+
+            # Sessions that are only written aren't loaded to check, and are
+            # always extended
+            redis.persist("test-redis-session-refresh")
+            session = oz.redis_sessions.RedisSession(redis, "test-redis-session-refresh")
+            session.set("b", "2")
+            self.assertTrue(session.needs_refresh(60, 0.5))
+            self.assertFalse(session.loaded)
+            pipe = redis.pipeline(transaction=False)
+            session.save(pipe, 60, 0.5)
+            pipe.execute()
+            self.assertTrue(redis.ttl("test-redis-session-refresh") > 0)
+        finally:
+            redis.delete("test-redis-session-refresh")
+
+    def test_cookie_session_encoding(self):
+        data = {"foo": b"bar", "binary": b"\x00\xff"}
+        payload = oz.redis_sessions.encode_cookie_session(data)
+        self.assertEqual(payload[:1], oz.redis_sessions.COOKIE_SESSION_JSON)
+        self.assertEqual(oz.redis_sessions.decode_cookie_session(payload), data)
+
+        data = {"foo": b"bar" * 100}
+        payload = oz.redis_sessions.encode_cookie_session(data, compress_threshold=100)
+        self.assertEqual(payload[:1], oz.redis_sessions.COOKIE_SESSION_ZLIB)
+        self.assertTrue(len(payload) < 100)
+        self.assertEqual(oz.redis_sessions.decode_cookie_session(payload), data)
+
+        # The touched time is kept out of cookie session values
+        session = oz.redis_sessions.CookieSession({"foo": b"bar", oz.redis_sessions.TOUCHED_FIELD: b"1000.5"})
+        self.assertEqual(session.data, {"foo": b"bar"})
+        self.assertEqual(session.touched, 1000.5)
+
+    def test_serialize_value(self):
+        # Raw values are stored as-is, so existing sessions still read fine
+        self.assertEqual(oz.redis_sessions.serialize_value("foo", "raw", 0), b"foo")
+        self.assertEqual(oz.redis_sessions.deserialize_value(b"foo"), b"foo")
+        self.assertEqual(oz.redis_sessions.deserialize_value(None), None)
+
+        value = {"foo": [1, 2.5, None, "bar"]}
+        serialized = oz.redis_sessions.serialize_value(value, "json", 0)
+        self.assertEqual(serialized[:2], oz.redis_sessions.SERIALIZED_JSON)
+        self.assertEqual(oz.redis_sessions.deserialize_value(serialized), value)
+
+        value = "foo" * 100
+        serialized = oz.redis_sessions.serialize_value(value, "json", 100)
+        self.assertEqual(serialized[:2], oz.redis_sessions.SERIALIZED_ZLIB)
+        self.assertTrue(len(serialized) < 100)
+        self.assertEqual(oz.redis_sessions.deserialize_value(serialized), value)
+
+        serialized = oz.redis_sessions.serialize_value(value, "raw", 100)
+        self.assertEqual(oz.redis_sessions.deserialize_value(serialized), value.encode("utf-8"))
+
+        self.assertRaises(Exception, oz.redis_sessions.serialize_value, "foo", "pickle", 0)
+
+        # Values that redis decoded to strings (`redis_decode_responses`)
+        value = {"foo": ["bar", "\u00e9"]}
+        serialized = oz.redis_sessions.serialize_value(value, "json", 0)
+        self.assertEqual(oz.redis_sessions.deserialize_value(serialized.decode("utf-8")), value)
+        self.assertEqual(oz.redis_sessions.deserialize_value("foo"), "foo")
+
+    @unittest.skipIf(oz.redis_sessions.msgpack == None, "msgpack is not installed")
+    def test_serialize_value_msgpack(self):
+        value = {"foo": [1, 2.5, None, "bar"]}
+        serialized = oz.redis_sessions.serialize_value(value, "msgpack", 0)
+        self.assertEqual(serialized[:2], oz.redis_sessions.SERIALIZED_MSGPACK)
+        self.assertEqual(oz.redis_sessions.deserialize_value(serialized), value)
+
+    def test_session_maintenance(self):
+        redis = oz.redis.create_connection()
+        keys = [oz.redis_sessions.SESSION_KEY_TEMPLATE % ("test%s" % i, "vtest") for i in range(5)]
+
+        try:
+            for i, key in enumerate(keys):
+                redis.hset(key, "foo", "bar")
+                redis.hset(key, oz.redis_sessions.TOUCHED_FIELD, 1000 * i)
+
+                if i % 2 == 0:
+                    redis.hset(key, "even", "1")
+                    redis.expire(key, 60)
+
+            self.assertEqual(sum(len(batch) for batch in oz.redis_sessions.scan_sessions(redis, version="vtest", batch_size=2)), 5)
+
+            stats = oz.redis_sessions.session_stats(redis, version="vtest", batch_size=2)
+            self.assertEqual(stats["sessions"], 5)
+            # The touched field isn't counted as a value
+            self.assertEqual(stats["values"], 8)
+            self.assertEqual(stats["persistent"], 2)
+
+            self.assertEqual(oz.redis_sessions.purge_sessions(redis, version="vtest", persistent=True, dry_run=True), 2)
+            self.assertEqual(oz.redis_sessions.purge_sessions(redis, version="vtest", field="even", touched_before=2500), 2)
+            self.assertFalse(redis.exists(keys[0]))
+            self.assertFalse(redis.exists(keys[2]))
+            self.assertTrue(redis.exists(keys[4]))
+
+            # Without the touched field, idle time comes from the TTL, so a
+            # session expiring in 60 seconds was last used 40 seconds ago
+            redis.hdel(keys[4], oz.redis_sessions.TOUCHED_FIELD)
+            self.assertEqual(oz.redis_sessions.purge_sessions(redis, version="vtest", field="even", touched_before=time.time() - 30, session_time=100, dry_run=True), 1)
+            self.assertEqual(oz.redis_sessions.purge_sessions(redis, version="vtest", field="even", touched_before=time.time() - 50, session_time=100, dry_run=True), 0)
+            self.assertEqual(oz.redis_sessions.purge_sessions(redis, version="vtest", field="even", touched_before=time.time() - 30, dry_run=True), 0)
+
+            # Sessions that already exist under the new version are kept
+            redis.hset(oz.redis_sessions.SESSION_KEY_TEMPLATE % ("test1", "vtest2"), "foo", "baz")
+            self.assertEqual(oz.redis_sessions.migrate_sessions(redis, "vtest", "vtest2"), (2, 1))
+            self.assertEqual(redis.hget(oz.redis_sessions.SESSION_KEY_TEMPLATE % ("test1", "vtest2"), "foo"), b"baz")
+            self.assertEqual(redis.hget(oz.redis_sessions.SESSION_KEY_TEMPLATE % ("test3", "vtest2"), "foo"), b"bar")
+        finally:
+            for key in redis.scan_iter("session:*:vtest*"):
+                redis.delete(key)
@@ -3,8 +3,12 @@ from __future__ import absolute_import, division, print_function, with_statement
 import oz
 import oz.testing
 import collections
-from oz.redis_sessions import RedisSessionMiddleware
+import json
+import threading
+import oz.redis_sessions
+from oz.redis_sessions import RedisSessionMiddleware, CookieSessionMiddleware
 from oz.redis import RedisMiddleware
+from tornado import gen, web
 
 @oz.test
 class RedisSessionMiddlewareTestCase(oz.testing.OzTestCase):
@@ -26,15 +30,56 @@ class RedisSessionMiddlewareTestCase(oz.testing.OzTestCase):
             def get(self):
                 self.finish(self.clear_session_value(self.get_argument("name")))
 
+        class AsyncSessionHandler(oz.testing.FakeCookiesHandler, RedisMiddleware, RedisSessionMiddleware):
+            @gen.coroutine
+            def get(self):
+                value = yield self.get_session_value_async(self.get_argument("name"))
+                self.finish(value or b"")
+
+            @gen.coroutine
+            def put(self):
+                yield self.set_session_value_async(self.get_argument("name"), self.get_argument("value"))
+
+            @gen.coroutine
+            def post(self):
+                # Concurrent calls on a handler that hasn't set up its session
+                # yet, which should only send its cookie from the ioloop thread
+                self.cookie_threads = set()
+                names = ["%s_%s" % (self.get_argument("name"), i) for i in range(8)]
+                yield [self.set_session_value_async(name, name) for name in names]
+                values = yield [self.get_session_value_async(name) for name in names]
+
+                if self.cookie_threads != set([threading.current_thread()]):
+                    raise web.HTTPError(500)
+
+                self.finish(b",".join(values))
+
+            def set_secure_cookie(self, *args, **kwargs):
+                if hasattr(self, "cookie_threads"):
+                    self.cookie_threads.add(threading.current_thread())
+
+                super(AsyncSessionHandler, self).set_secure_cookie(*args, **kwargs)
+
         class SessionClearerHandler(oz.testing.FakeCookiesHandler, RedisMiddleware, RedisSessionMiddleware):
             def get(self):
                 self.clear_all_session_values()
 
+        class SessionUpdaterHandler(oz.testing.FakeCookiesHandler, RedisMiddleware, RedisSessionMiddleware):
+            def get(self):
+                # Several reads and writes, which are all sent when the request finishes
+                count = int(self.get_session_value("count", 0)) + 1
+                self.set_session_value("count", count)
+                self.set_session_value("last", self.get_argument("value"))
+                self.clear_session_value("removed")
+                self.finish(self.get_session_value("count"))
+
         return [
             ("/get", SessionGetterHandler),
+            ("/update", SessionUpdaterHandler),
             ("/set", SessionSetterHandler),
             ("/del", SessionDeleterHandler),
             ("/clear", SessionClearerHandler),
+            ("/async", AsyncSessionHandler),
         ]
 
     def tearDown(self):
@@ -43,7 +88,7 @@ class RedisSessionMiddlewareTestCase(oz.testing.OzTestCase):
         # Clean up just in case there's keys still lying around
         redis = oz.redis.create_connection()
 
-        for key in redis.keys("session:*:v1"):
+        for key in redis.scan_iter("session:*:v4"):
             redis.delete(key)
 
     def test_session_value(self):
@@ -84,3 +129,195 @@ class RedisSessionMiddlewareTestCase(oz.testing.OzTestCase):
 
         response = self.request("/get?name=clear_all_value_2&cookie_id=test_clear_all_session_values")
         self.assertEqual(response.body, b"")
+
+    def test_session_value_async(self):
+        response = self.request("/async?name=async_value&value=qux&cookie_id=test_session_value_async", method="PUT", body="")
+        self.assertEqual(response.code, 200)
+
+        response = self.request("/async?name=async_value&cookie_id=test_session_value_async")
+        self.assertEqual(response.body, b"qux")
+
+        response = self.request("/get?name=async_value&cookie_id=test_session_value_async")
+        self.assertEqual(response.body, b"qux")
+
+    def test_session_value_async_concurrent(self):
+        response = self.request("/async?name=concurrent&cookie_id=test_session_value_async_concurrent", method="POST", body="")
+        self.assertEqual(response.body, b",".join(("concurrent_%s" % i).encode("utf-8") for i in range(8)))
+
+        for i in range(8):
+            response = self.request("/get?name=concurrent_%s&cookie_id=test_session_value_async_concurrent" % i)
+            self.assertEqual(response.body, ("concurrent_%s" % i).encode("utf-8"))
+
+    def test_session_updates(self):
+        response = self.request("/set?name=removed&value=foo&cookie_id=test_session_updates")
+        self.assertEqual(response.code, 200)
+
+        response = self.request("/update?value=a&cookie_id=test_session_updates")
+        self.assertEqual(response.body, b"1")
+
+        response = self.request("/update?value=b&cookie_id=test_session_updates")
+        self.assertEqual(response.body, b"2")
+
+        response = self.request("/get?name=last&cookie_id=test_session_updates")
+        self.assertEqual(response.body, b"b")
+
+        response = self.request("/get?name=removed&cookie_id=test_session_updates")
+        self.assertEqual(response.body, b"")
+
+@oz.test
+class ThrottledRedisSessionMiddlewareTestCase(oz.testing.OzTestCase):
+    forced_settings = {
+        "session_salt": "abc",
+        "session_time": 60 * 1000,
+        "session_refresh_fraction": 0.5,
+    }
+
+    def get_handlers(self):
+        class SessionCookieHandler(oz.testing.FakeCookiesHandler, RedisMiddleware, RedisSessionMiddleware):
+            def get(self):
+                # Reports whether the session cookie had to be sent
+                self.get_session_value("foo")
+                self.finish("set" if self._session_cookie_set else "unset")
+
+            def put(self):
+                # Reports whether writing needed the session loaded
+                self.set_session_value("foo", "bar")
+                self.finish("loaded" if self._session.loaded else "unloaded")
+
+        return [
+            ("/cookie", SessionCookieHandler),
+        ]
+
+    def test_session_cookie(self):
+        response = self.request("/cookie?cookie_id=test_session_cookie", method="PUT", body="")
+        self.assertEqual(response.body, b"unloaded")
+
+        response = self.request("/cookie?cookie_id=test_session_cookie")
+        self.assertEqual(response.body, b"unset")
+
+        response = self.request("/cookie?cookie_id=test_session_cookie_new")
+        self.assertEqual(response.body, b"set")
+
+        # Sessions that are only written aren't loaded to check the refresh
+        response = self.request("/cookie?cookie_id=test_session_cookie", method="PUT", body="")
+        self.assertEqual(response.body, b"unloaded")
+
+@oz.test
+class CookieSessionMiddlewareTestCase(oz.testing.OzTestCase):
+    forced_settings = {
+        "session_time": 60 * 1000,
+        "session_cookie_max_size": 512,
+    }
+
+    def get_handlers(self):
+        class CookieSessionHandler(oz.testing.FakeCookiesHandler, RedisMiddleware, CookieSessionMiddleware):
+            def get(self):
+                self.finish(self.get_session_value(self.get_argument("name"), self.get_argument("default", None)))
+
+            def put(self):
+                self.set_session_value(self.get_argument("name"), self.request.body)
+
+            def delete(self):
+                if self.get_argument("name", None):
+                    self.clear_session_value(self.get_argument("name"))
+                else:
+                    self.clear_all_session_values()
+
+        return [
+            ("/session", CookieSessionHandler),
+        ]
+
+    def stored_in_redis(self, cookie_id):
+        payload = oz.testing.cookie_jar[cookie_id].get("session_data")
+        payload = web.decode_signed_value(self.app.settings["cookie_secret"], "session_data", payload)
+        return payload != None and payload[:1] == oz.redis_sessions.COOKIE_SESSION_REDIS
+
+    def test_cookie_session_value(self):
+        response = self.request("/session?name=foo&cookie_id=test_cookie_session_value", method="PUT", body="bar")
+        self.assertEqual(response.code, 200)
+
+        response = self.request("/session?name=foo&cookie_id=test_cookie_session_value")
+        self.assertEqual(response.body, b"bar")
+        self.assertFalse(self.stored_in_redis("test_cookie_session_value"))
+
+        response = self.request("/session?name=baz&default=qux&cookie_id=test_cookie_session_value")
+        self.assertEqual(response.body, b"qux")
+
+        response = self.request("/session?name=foo&cookie_id=test_cookie_session_value", method="DELETE")
+        self.assertEqual(response.code, 200)
+
+        response = self.request("/session?name=foo&cookie_id=test_cookie_session_value")
+        self.assertEqual(response.body, b"")
+
+    def test_cookie_session_redis_fallback(self):
+        large_value = oz.redis_sessions.random_hex(2048)
+
+        response = self.request("/session?name=small&cookie_id=test_cookie_session_fallback", method="PUT", body="foo")
+        self.assertEqual(response.code, 200)
+        self.assertFalse(self.stored_in_redis("test_cookie_session_fallback"))
+
+        response = self.request("/session?name=large&cookie_id=test_cookie_session_fallback", method="PUT", body=large_value)
+        self.assertEqual(response.code, 200)
+        self.assertTrue(self.stored_in_redis("test_cookie_session_fallback"))
+
+        response = self.request("/session?name=small&cookie_id=test_cookie_session_fallback")
+        self.assertEqual(response.body, b"foo")
+
+        response = self.request("/session?name=large&cookie_id=test_cookie_session_fallback")
+        self.assertEqual(response.body, large_value.encode("utf-8"))
+
+        response = self.request("/session?cookie_id=test_cookie_session_fallback", method="DELETE")
+        self.assertEqual(response.code, 200)
+        self.assertFalse(self.stored_in_redis("test_cookie_session_fallback"))
+
+        response = self.request("/session?name=small&cookie_id=test_cookie_session_fallback")
+        self.assertEqual(response.body, b"")
+
+@oz.test
+class SerializedRedisSessionMiddlewareTestCase(oz.testing.OzTestCase):
+    forced_settings = {
+        "session_salt": "abc",
+        "session_time": 60 * 1000,
+        "session_serializer": "json",
+    }
+
+    def get_handlers(self):
+        class TypedSessionHandler(oz.testing.FakeCookiesHandler, RedisMiddleware, RedisSessionMiddleware):
+            def get(self):
+                value = self.get_session_value("typed")
+                self.finish({"value": value})
+
+            def put(self):
+                self.set_session_value("typed", {"count": 1, "names": ["foo"]})
+
+        return [
+            ("/typed", TypedSessionHandler),
+        ]
+
+    def test_typed_session_value(self):
+        response = self.request("/typed?cookie_id=test_typed_session_value", method="PUT", body="")
+        self.assertEqual(response.code, 200)
+
+        response = self.request("/typed?cookie_id=test_typed_session_value")
+        self.assertEqual(json.loads(response.body.decode("utf-8")), {"value": {"count": 1, "names": ["foo"]}})
+
+@oz.test
+class DecodedSerializedRedisSessionMiddlewareTestCase(SerializedRedisSessionMiddlewareTestCase):
+    forced_settings = {
+        "session_salt": "abc",
+        "session_time": 60 * 1000,
+        "session_serializer": "json",
+        "redis_connections": {
+            "sessions": {"decode_responses": True},
+        },
+    }
+
+    def setUp(self):
+        super(DecodedSerializedRedisSessionMiddlewareTestCase, self).setUp()
+        oz.redis._pools.pop("sessions", None)
+        oz.redis._cached_connections.pop("sessions", None)
+
+    def tearDown(self):
+        super(DecodedSerializedRedisSessionMiddlewareTestCase, self).tearDown()
+        oz.redis._pools.pop("sessions", None)
+        oz.redis._cached_connections.pop("sessions", None)